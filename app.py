@@ -15,14 +15,33 @@ import datetime as dt
 import requests
 import json
 from utils import *
-from dash.dependencies import Input, Output
+from dash.dependencies import ClientsideFunction, Input, Output, State
+from dash.exceptions import PreventUpdate
 
 from plotly.subplots import make_subplots
 
 
 States = Make_State_Dict()
 
-df = Get_Data()
+# the first fetch happens on the refresher thread, the layout below starts out with
+# placeholder figures so the app can serve before any data is loaded
+Start_Refresher()
+
+DATA_POLL = 5 * 60000 # ms between checks for a new data version once the page has data
+
+
+def Load_Version(version):
+    """The dataset of the page's version token. A token this server doesn't have (pruned, or
+    handed out by another dyno with its own store) gets the current data instead, and the
+    page picks up its token on the next Update_Data."""
+    
+    for candidate in (version, Current_Version()) :
+        try :
+            return Load_Data(candidate)
+        except KeyError :
+            pass
+    
+    raise PreventUpdate
 
 #%%
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
@@ -31,6 +50,7 @@ app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
 app.config['suppress_callback_exceptions'] = True
 #application=app.server
 server = app.server
+Install_Metrics(server, app.callback_map) # /metrics and Server-Timing headers, with COVID_METRICS=1
 colors = {
     'background': 'gray',
     'background2': 'lightgray',
@@ -45,7 +65,7 @@ colors = {
 
 app.layout = html.Div([ 
     dcc.Interval(id='get_data_interval',
-                 interval = 1 * 3600000,
+                 interval = 2000, # poll quickly until the first data version arrives
                  n_intervals=0),
    
     html.H1(
@@ -112,7 +132,7 @@ app.layout = html.Div([
             ),
         
     html.Div([
-        dcc.Graph(id='Nat', figure = Make_National(df))
+        dcc.Graph(id='Nat', figure = Placeholder_Figure())
         ],
         style={
 
@@ -127,7 +147,7 @@ app.layout = html.Div([
 
 
     html.Div([
-        dcc.Graph(id='Top_10', figure = Make_Top_Ten(df))
+        dcc.Graph(id='Top_10', figure = Placeholder_Figure())
         ],
         style={
 
@@ -141,7 +161,7 @@ app.layout = html.Div([
         ),
 
     html.Div([
-        dcc.Graph(id='Nat_Test_Plot', figure = Make_National_Test_Plot(df))
+        dcc.Graph(id='Nat_Test_Plot', figure = Placeholder_Figure())
         ],
         style={
 
@@ -155,7 +175,7 @@ app.layout = html.Div([
         ),
 
     html.Div([
-        dcc.Graph(id='R_B', figure = Make_R_B_National(df))
+        dcc.Graph(id='R_B', figure = Placeholder_Figure())
         ],
         style={
 
@@ -170,7 +190,7 @@ app.layout = html.Div([
 
     
     html.Div([
-        dcc.Graph(id='R_B_Sum', figure = Make_R_B_Sum(df))
+        dcc.Graph(id='R_B_Sum', figure = Placeholder_Figure())
         ],
         style={
 
@@ -185,6 +205,12 @@ app.layout = html.Div([
     
         html.Div(id='Update_df', style={'display': 'none'}),
         
+        # every state's series, only filled with COVID_CLIENTSIDE_STATES=1
+        dcc.Store(id='state_bundle'),
+        
+        # data version the national figures show, so a refresh can send only what is new
+        dcc.Store(id='national_version'),
+        
         
         html.H2('State Outlook:',style={
         'textAlign': 'left',
@@ -209,7 +235,7 @@ app.layout = html.Div([
        ),
     
     html.Div([
-        dcc.Graph(id='State', figure = Make_State(df,'UT'))
+        dcc.Graph(id='State', figure = Placeholder_Figure())
         ],
         style={
 
@@ -223,7 +249,7 @@ app.layout = html.Div([
         ),
     
     html.Div([
-        dcc.Graph(id='Test_Plot', figure = Make_Test_Plot(df,'UT'))
+        dcc.Graph(id='Test_Plot', figure = Placeholder_Figure())
         ],
         style={
 
@@ -258,68 +284,106 @@ app.layout = html.Div([
 
 
 @app.callback(
-    Output('Update_df', 'children'),
-    [Input('get_data_interval', 'n_intervals')])
-def Update_Data(n):
-     # an expensive query step
-     updated_df = Get_Data()
-
-
-
-     return updated_df.to_json(date_format='iso', orient='split')
-
-@app.callback([
-    Output('Nat','figure'),
-    Output('Nat_Test_Plot','figure'),
-    Output('Top_10','figure'),
-    Output('R_B','figure'),
-    Output('R_B_Sum','figure'),
-    Output('update','children')],
-    [Input('Update_df', 'children')])
-def update_Nat(json_updated_df):
-    dataset = json.loads(json_updated_df)
-    dff = pd.read_json(json_updated_df, orient='split')
-    
-    return (
-       
-        Make_National(dff),
-        
-        Make_National_Test_Plot(dff),
-        
-        Make_Top_Ten(dff),
-        
-        Make_R_B_National(dff),
-        
-        Make_R_B_Sum(dff),
-    
-        Make_Update()
-        )
+    [Output('Update_df', 'children'),
+     Output('get_data_interval', 'interval')],
+    [Input('get_data_interval', 'n_intervals')],
+    [State('Update_df', 'children')])
+def Update_Data(n, current):
+     # the refresher thread does the expensive query, here we only check for a new version
+     version = Current_Version()
+     
+     if version is None or version == current :
+         raise PreventUpdate
+
+     return version, DATA_POLL
 
+NATIONAL_GRAPHS = ['Nat', 'Nat_Test_Plot', 'Top_10', 'R_B', 'R_B_Sum']
 
+@app.callback(
+    [Output(name, 'figure') for name in NATIONAL_GRAPHS] +
+    [Output(name, 'extendData') for name in NATIONAL_GRAPHS] +
+    [Output('update','children'),
+     Output('national_version', 'data')],
+    [Input('Update_df', 'children')],
+    [State('national_version', 'data')])
+def update_Nat(version, shown):
+    if version is None :
+        raise PreventUpdate
+    
+    # the national figures are rendered once per data version by the refresher
+    data = Load_Version(version)
+    
+    # a refresh that only added days sends just the new points of the figures the page
+    # already shows, a revised history or a page without figures gets them whole
+    figures, extensions = [], []
+    for name in NATIONAL_GRAPHS :
+        extension = National_Extension(data, shown, name) if shown is not None else None
+        if extension is None :
+            figures.append(National_Figure(data, name))
+            extensions.append(dash.no_update)
+        else :
+            figures.append(dash.no_update)
+            extensions.append(extension)
+    
+    return figures + extensions + [Make_Update(), data['version']]
 
 
-@app.callback([
-    Output('Test_Plot','figure'),
-    Output('State','figure'), 
-        ],
-    [Input('States Dropdown', 'value'),
-     Input('Update_df','children')]
-    )
 
 
-def Update_State_Plots(value,jsonified_cleaned_data):
-    state_of_choice = value
+if CLIENTSIDE_STATES :
     
-    dataset = json.loads(jsonified_cleaned_data)
-    dff = pd.read_json(jsonified_cleaned_data, orient='split')
-
-    return (
-       
-        Make_Test_Plot(dff,state_of_choice),
+    # the browser gets every state's series once per data version and draws the state
+    # figures itself, see assets/state_figures.js
+    @app.callback(
+        Output('state_bundle', 'data'),
+        [Input('Update_df', 'children')])
+    def Update_State_Bundle(version):
+        if version is None :
+            raise PreventUpdate
         
-        Make_State(dff,state_of_choice),
+        return State_Bundle(Load_Version(version))
     
+    app.clientside_callback(
+        ClientsideFunction(namespace='covid', function_name='state_figures'),
+        [Output('Test_Plot','figure'),
+         Output('State','figure')],
+        [Input('States Dropdown', 'value'),
+         Input('state_bundle', 'data')])
+
+else :
+    
+    @app.callback([
+        Output('Test_Plot','figure'),
+        Output('State','figure'), 
+            ],
+        [Input('States Dropdown', 'value'),
+         Input('Update_df','children')]
         )
+    
+    
+    def Update_State_Plots(value,version):
+        state_of_choice = value
+        
+        if version is None :
+            raise PreventUpdate
+        
+        if not isinstance(state_of_choice, str) :
+            raise PreventUpdate
+        
+        data = Load_Version(version)
+        
+        try :
+            return (
+               
+                Cached_Figure(Make_Test_Plot,data,state_of_choice),
+                
+                Cached_Figure(Make_State,data,state_of_choice),
+            
+                )
+        except KeyError :
+            # a state in the dropdown the data has no rows for
+            return (Placeholder_Figure('No data for ' + state_of_choice),
+                    Placeholder_Figure('No data for ' + state_of_choice))
  
 
 
@@ -0,0 +1,176 @@
+/*
+ * Clientside state figures, used when the app runs with COVID_CLIENTSIDE_STATES=1.
+ *
+ * The server sends every state's series once per data version (utils.Make_State_Bundle),
+ * and the figures Make_State and Make_Test_Plot draw on the server are built here from it,
+ * so switching states costs no request at all.
+ */
+
+(function() {
+
+    var DAY_MS = 86400000;
+
+    // utils.color
+    var COLOR = {'7-day': 'Black', '20-day': 'Forestgreen', 'Bar': 'slategray', 'Bar2': 'Red'};
+
+    var LEGEND = {'yanchor': 'top', 'y': 0.99, 'xanchor': 'left', 'x': 0.01};
+
+    // the series of the last bundle, decoded once per data version
+    var decoded = {'version': null, 'series': null};
+
+    function decode(bdata) {
+        var bytes = atob(bdata);
+        var buffer = new Uint8Array(bytes.length);
+        for (var i = 0; i < bytes.length; i++) {
+            buffer[i] = bytes.charCodeAt(i);
+        }
+        return new Float32Array(buffer.buffer);
+    }
+
+    function series(bundle) {
+        if (decoded.version !== bundle.version) {
+            var all = {};
+            Object.keys(bundle.series).forEach(function(name) {
+                all[name] = decode(bundle.series[name]);
+            });
+            decoded = {'version': bundle.version, 'series': all};
+        }
+        return decoded.series;
+    }
+
+    // a state's values of one series from its first to its last reported day, lag days late
+    // like State_Series, with the gaps as null
+    function slice(values, bundle, i, lag) {
+        var out = [];
+        var offset = i * bundle.days;
+        for (var d = bundle.first[i]; d <= bundle.last[i]; d++) {
+            var v = d - lag >= 0 ? values[offset + d - lag] : NaN;
+            out.push(isFinite(v) ? v : null);
+        }
+        return out;
+    }
+
+    function title(text) {
+        return {'text': text, 'font': {'size': 24}, 'x': 0.5};
+    }
+
+    function subplotTitle(text, x) {
+        return {'text': text, 'font': {'size': 16}, 'showarrow': false,
+                'x': x, 'xanchor': 'center', 'xref': 'paper',
+                'y': 1.0, 'yanchor': 'bottom', 'yref': 'paper'};
+    }
+
+    function trace(type, x0, y, col, secondaryY, props) {
+        var suffix = col === 1 ? '' : String(col);
+        var t = {'type': type, 'xaxis': 'x' + suffix, 'yaxis': secondaryY ? 'y2' : 'y' + suffix,
+                 'x0': x0, 'dx': DAY_MS, 'y': y};
+        return Object.assign(t, props);
+    }
+
+    // utils.Make_State
+    function stateFigure(state, x0, s, bundle) {
+        return {
+            'data': [
+                trace('bar', x0, s.cases, 1, false,
+                      {'marker': {'color': COLOR['Bar']}, 'legendgroup': 'Bars',
+                       'name': state + ' Daily Increase'}),
+                trace('scatter', x0, s.cases_7, 1, false,
+                      {'marker': {'color': COLOR['7-day']}, 'line': {'width': 4}, 'legendgroup': '7Day',
+                       'name': '7-Day Average'}),
+                trace('scatter', x0, s.cases_20, 1, false,
+                      {'marker': {'color': COLOR['20-day']}, 'line': {'width': 2}, 'legendgroup': '20Day',
+                       'name': '20-Day Average'}),
+                trace('bar', x0, s.deaths, 2, false,
+                      {'marker': {'color': COLOR['Bar']}, 'legendgroup': 'Bars', 'showlegend': false,
+                       'name': state + ' Daily Deaths Increase'}),
+                trace('scatter', x0, s.deaths_7, 2, false,
+                      {'marker': {'color': COLOR['7-day']}, 'line': {'width': 2}, 'legendgroup': '7Day',
+                       'showlegend': false, 'name': '7-Day Average'}),
+                trace('scatter', x0, s.deaths_20, 2, false,
+                      {'marker': {'color': COLOR['20-day']}, 'line': {'width': 2}, 'legendgroup': '20Day',
+                       'showlegend': false, 'name': '20-Day Average'})
+            ],
+            'layout': {
+                'template': bundle.template,
+                'xaxis': {'anchor': 'y', 'domain': [0.0, 0.45], 'title': {'text': 'Date'}},
+                'yaxis': {'anchor': 'x', 'domain': [0.0, 1.0], 'title': {'text': 'New Cases'}},
+                'xaxis2': {'anchor': 'y2', 'domain': [0.55, 1.0], 'title': {'text': 'Date'}},
+                'yaxis2': {'anchor': 'x2', 'domain': [0.0, 1.0], 'title': {'text': 'New Deaths'}},
+                'annotations': [subplotTitle(state + ' Cases per Day', 0.225),
+                                subplotTitle(state + ' Deaths per Day', 0.775)],
+                'title': title(state + ' Cases and Deaths'),
+                'legend': LEGEND
+            }
+        };
+    }
+
+    // utils.Make_Test_Plot
+    function testFigure(state, x0, s, bundle) {
+        return {
+            'data': [
+                trace('bar', x0, s.tests, 1, false,
+                      {'marker': {'color': COLOR['Bar']}, 'name': 'Total Tests', 'legendgroup': 'Tests',
+                       'offsetgroup': '0'}),
+                trace('bar', x0, s.cases, 1, false,
+                      {'marker': {'color': COLOR['Bar2']}, 'name': 'Positive Tests', 'offsetgroup': '0',
+                       'legendgroup': 'Cases'}),
+                trace('scatter', x0, s.tests_7_lag, 1, false,
+                      {'marker': {'color': 'Black'}, 'line': {'width': 2}, 'name': '7-Day Average',
+                       'legendgroup': 'Tests'}),
+                trace('scatter', x0, s.cases_7_lag, 1, false,
+                      {'marker': {'color': 'FireBrick'}, 'line': {'width': 2}, 'name': '7-Day Average',
+                       'legendgroup': 'Cases'}),
+                trace('scatter', x0, s.rate, 1, true,
+                      {'mode': 'markers', 'marker': {'color': 'Green', 'size': 7}, 'name': 'Infection Rate',
+                       'legendgroup': 'Infection'}),
+                trace('scatter', x0, s.rate_7_lag, 1, true,
+                      {'marker': {'color': 'forestgreen'}, 'line': {'width': 3},
+                       'name': '7-Day Average Infection Rate', 'legendgroup': 'Infection'})
+            ],
+            'layout': {
+                'template': bundle.template,
+                'xaxis': {'anchor': 'y', 'domain': [0.0, 0.94], 'title': {'text': 'Date'}},
+                'yaxis': {'anchor': 'x', 'domain': [0.0, 1.0], 'title': {'text': 'Tests'}},
+                'yaxis2': {'anchor': 'x', 'overlaying': 'y', 'side': 'right', 'showgrid': false,
+                           'title': {'text': 'Infection Rate (%)'}, 'range': [0, 50]},
+                'height': 700,
+                'width': 1000,
+                'title': title(state + ' Tests and Infection Rate'),
+                'legend': LEGEND
+            }
+        };
+    }
+
+    window.dash_clientside = Object.assign({}, window.dash_clientside, {
+        covid: {
+            // outputs Test_Plot and State, like Update_State_Plots on the server
+            state_figures: function(state, bundle) {
+                var i = bundle ? bundle.states.indexOf(state) : -1;
+                if (i < 0) {
+                    return [window.dash_clientside.no_update, window.dash_clientside.no_update];
+                }
+
+                var all = series(bundle);
+                var s = {
+                    'cases': slice(all['positiveIncrease'], bundle, i, 0),
+                    'cases_7': slice(all['positiveIncrease_7'], bundle, i, 0),
+                    'cases_20': slice(all['positiveIncrease_20'], bundle, i, 0),
+                    'deaths': slice(all['deathIncrease'], bundle, i, 0),
+                    'deaths_7': slice(all['deathIncrease_7'], bundle, i, 0),
+                    'deaths_20': slice(all['deathIncrease_20'], bundle, i, 0),
+                    'tests': slice(all['totalTestResultsIncrease'], bundle, i, 0),
+                    'rate': slice(all['PosPerTest'], bundle, i, 0),
+                    'tests_7_lag': slice(all['totalTestResultsIncrease_7'], bundle, i, 1),
+                    'cases_7_lag': slice(all['positiveIncrease_7'], bundle, i, 1),
+                    'rate_7_lag': slice(all['PosPerTest_7'], bundle, i, 1)
+                };
+
+                var start = new Date(bundle.start + 'T00:00:00Z');
+                var x0 = new Date(start.getTime() + bundle.first[i] * DAY_MS).toISOString().slice(0, 10);
+
+                return [testFigure(state, x0, s, bundle), stateFigure(state, x0, s, bundle)];
+            }
+        }
+    });
+
+})();
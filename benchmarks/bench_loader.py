@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Time and peak memory of reading the upstream payload into the cleaned frame,
+with Parse_Records against the json + json_normalize it replaced.
+
+    python benchmarks/bench_loader.py [days]
+"""
+
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd
+
+import utils
+from synthetic import Make_Payload, Payload_Chunks
+
+
+def Legacy_Load(chunks):
+    """Parse the whole body and flatten every record, as Get_Data did before Parse_Records"""
+    
+    return pd.json_normalize(json.loads(b''.join(chunks)))
+
+
+def Measure(func, *args):
+    """Seconds for one call, and its peak traced memory in MB from a second call, since
+    tracing slows the allocations down"""
+    
+    start = time.perf_counter()
+    func(*args)
+    elapsed = time.perf_counter() - start
+    
+    tracemalloc.start()
+    func(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    
+    return elapsed, peak / 2**20
+
+
+if __name__ == '__main__':
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    chunks = Payload_Chunks(Make_Payload(days))
+    
+    print('payload: %d bytes in %d chunks' % (sum(map(len, chunks)), len(chunks)))
+    print('  json + json_normalize: %6.3f s  peak %7.1f MB' % Measure(Legacy_Load, chunks))
+    print('  Parse_Records:         %6.3f s  peak %7.1f MB' % Measure(utils.Parse_Records, chunks))
+    print('  Parse_Records + Clean: %6.3f s  peak %7.1f MB'
+          % Measure(lambda: utils.Clean_Data(utils.Parse_Records(chunks))))
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Time every stage of the utils.py pipeline on a synthetic payload, offline, and
+write the results as JSON so runs on different commits can be compared.
+
+    python benchmarks/bench_pipeline.py [--days 400] [--regions 56] [--repeat 5]
+                                        [--output results.json] [--compare old.json]
+
+--regions past the 56 states adds made up regions, up to county sized row
+counts. Those rows go through parsing, the States_Won/State_Pop enrichment
+and Roll_Avg; Clean_Data keeps only the states it has a population for, so
+the dataset and figure stages always see the states.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import numpy as np
+import pandas as pd
+
+import utils
+from synthetic import Payload_Body, Regions
+
+
+def Time(func, repeat):
+    """Seconds of each of repeat calls of func, after one untimed warm up call"""
+
+    func()
+    times = []
+    for _ in range(repeat) :
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    return times
+
+
+def Summary(times):
+
+    return {'min': min(times), 'median': statistics.median(times), 'mean': statistics.mean(times),
+            'runs': len(times)}
+
+
+def Commit():
+    """The checked out commit of the repo, if it is a git checkout"""
+
+    try :
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError) :
+        return None
+
+
+def Stages(chunks):
+    """(name, no argument callable) for every stage, each fed the output of the stages before it
+    computed once up front, so a stage is timed on its own"""
+
+    columns = utils.Parse_Records(chunks)
+
+    # every region, before Clean_Data narrows the rows down to the states
+    raw = pd.DataFrame(columns)
+    raw['PosPerTest'] = raw['positiveIncrease']/raw['totalTestResultsIncrease']*100
+    ordered = raw.sort_values(['state', 'date']).reset_index(drop=True)
+    groups = ordered['state'].cat.codes.to_numpy()
+
+    df = utils.Clean_Data(columns)
+    data = utils.Build_Dataset(df)
+    aggregates = data['aggregates']
+    state = 'NY' if 'NY' in data['roll']['states'] else data['roll']['states'][0]
+
+    stages = [
+        ('parse', lambda: utils.Parse_Records(chunks)),
+        ('clean', lambda: utils.Clean_Data(columns)),
+        ('enrich.States_Won', lambda: utils.States_Won(raw)),
+        ('enrich.State_Pop', lambda: utils.State_Pop(raw)),
+        ('Roll_Avg', lambda: utils.Roll_Avg(ordered.copy(), utils.ROLL_METRICS, utils.ROLL_WINDOWS,
+                                            shift=False, groups=groups)),
+        ('dataset.Make_Roll_Cube', lambda: utils.Make_Roll_Cube(data['df'])),
+        ('dataset.Make_Aggregates', lambda: utils.Make_Aggregates(data['df'])),
+        ('dataset.Make_Hotspots', lambda: utils.Make_Hotspots(data['roll'])),
+        ('dataset.Build_Dataset', lambda: utils.Build_Dataset(df)),
+        ]
+
+    builders = [('Make_National', lambda: utils.Make_National(aggregates)),
+                ('Make_National_Test_Plot', lambda: utils.Make_National_Test_Plot(aggregates)),
+                ('Make_Top_Ten', lambda: utils.Make_Top_Ten(data)),
+                ('Make_R_B_National', lambda: utils.Make_R_B_National(aggregates)),
+                ('Make_R_B_Sum', lambda: utils.Make_R_B_Sum(aggregates)),
+                ('Make_State', lambda: utils.Make_State(data, state)),
+                ('Make_Test_Plot', lambda: utils.Make_Test_Plot(data, state))]
+
+    for name, build in builders :
+        fig = build()
+        stages.append(('figure.' + name, build))
+        stages.append(('figure.' + name + '.json', lambda fig=fig: utils.Figure_JSON(fig)))
+
+    return stages, len(columns['date']), len(df)
+
+
+def Compare(results, baseline):
+    """Print the median of each stage next to the same stage of a baseline results file"""
+
+    print('\n%-36s %10s %10s %8s' % ('stage', 'base ms', 'now ms', 'ratio'), file=sys.stderr)
+    for name, now in results['stages'].items() :
+        base = baseline['stages'].get(name)
+        if base is None :
+            print('%-36s %10s %10.3f' % (name, '-', now['median'] * 1000), file=sys.stderr)
+            continue
+        print('%-36s %10.3f %10.3f %8.2f' % (name, base['median'] * 1000, now['median'] * 1000,
+                                             now['median'] / base['median']), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--days', type=int, default=400)
+    parser.add_argument('--regions', type=int, default=len(Regions()))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--lean', action='store_true', help='leave out the fields Clean_Data ignores')
+    parser.add_argument('--output', help='write the results here instead of stdout')
+    parser.add_argument('--compare', help='results file of an earlier run to compare against')
+    args = parser.parse_args()
+
+    chunks = Payload_Body(args.days, Regions(args.regions), lean=args.lean)
+    stages, rows, kept = Stages(chunks)
+
+    results = {'meta': {'commit': Commit(),
+                        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                        'python': platform.python_version(),
+                        'platform': platform.platform(),
+                        'numpy': np.__version__,
+                        'pandas': pd.__version__,
+                        'days': args.days,
+                        'regions': args.regions,
+                        'lean': args.lean,
+                        'payload_bytes': sum(map(len, chunks)),
+                        'rows': rows,
+                        'rows_cleaned': kept,
+                        'repeat': args.repeat},
+               'stages': {}}
+
+    for name, func in stages :
+        results['stages'][name] = Summary(Time(func, args.repeat))
+        print('%-36s %10.3f ms' % (name, results['stages'][name]['median'] * 1000), file=sys.stderr)
+
+    if args.output :
+        with open(args.output, 'w') as f :
+            json.dump(results, f, indent=1)
+    else :
+        json.dump(results, sys.stdout, indent=1)
+
+    if args.compare :
+        with open(args.compare) as f :
+            Compare(results, json.load(f))
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Time Clean_Data on a synthetic payload against the row loop it used to run
+for icuIncrease.
+
+    python benchmarks/bench_refresh.py [days]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils
+from synthetic import Make_Payload, Payload_Chunks
+
+
+def Legacy_ICU_Increase(df):
+    """The icuIncrease step as it was before Daily_Increase"""
+    
+    df['yadda'] = df['inIcuCumulative'].shift(-1)
+    
+    for row in df.iterrows() :
+        df['icuIncrease'] = df['inIcuCumulative'] - df['yadda']
+    
+    return df
+
+
+def Time(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    payload = utils.Parse_Records(Payload_Chunks(Make_Payload(days)))
+    df = utils.Clean_Data(payload)
+    
+    after = Time(utils.Clean_Data, payload)
+    loop = Time(Legacy_ICU_Increase, df.copy())
+    
+    print('rows:                    ', len(payload['date']))
+    print('Clean_Data (vectorized): ', round(after, 3), 's')
+    print('legacy icuIncrease loop: ', round(loop, 3), 's')
+    print('Clean_Data before (est.):', round(after + loop, 3), 's')
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Microbenchmark of Roll_Means against the pandas rolling loop Roll_Avg used to run,
+for a national series and for per-state windows over a (state, date) sorted frame.
+
+    python benchmarks/bench_roll.py [days]
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd
+
+import utils
+from synthetic import Make_Payload, Payload_Chunks
+
+COLUMNS = ['positiveIncrease', 'deathIncrease', 'PosPerTest', 'totalTestResultsIncrease']
+WINDOWS = [7, 10, 20]
+
+
+def Legacy_Roll_Avg(df, col, interval, shift=True):
+    """Roll_Avg as it was before Roll_Means"""
+    
+    for n in interval :
+        new_col = 'roll_' + str(col) + '_' + str(n)
+        if shift == False :
+            df[new_col] = df.loc[:, col].rolling(n).mean()
+        else :
+            df[new_col] = df.loc[:, col].rolling(n).mean().shift(periods=-n)
+
+
+def Legacy_National(national):
+    frame = national.copy()
+    for col in COLUMNS :
+        Legacy_Roll_Avg(frame, col, WINDOWS, shift=False)
+
+
+def Legacy_States(df):
+    for col in COLUMNS :
+        df.groupby('state')[col].apply(lambda x: x.rolling(10).mean())
+
+
+def Best(func, number):
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1000
+
+
+if __name__ == '__main__':
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    df = utils.Clean_Data(utils.Parse_Records(Payload_Chunks(Make_Payload(days)))).sort_values(['state', 'date']).reset_index(drop=True)
+    national = df.groupby('date')[COLUMNS].sum().reset_index()
+    
+    values = df[COLUMNS].to_numpy(dtype=float)
+    groups = df['state'].to_numpy()
+    
+    print('national series, %d rows, %d columns x %d windows' % (len(national), len(COLUMNS), len(WINDOWS)))
+    print('  legacy Roll_Avg:  %8.3f ms' % Best(lambda: Legacy_National(national), 50))
+    print('  Roll_Means:       %8.3f ms' % Best(lambda: utils.Roll_Means(national[COLUMNS].to_numpy(dtype=float), WINDOWS), 50))
+    
+    print('per state, %d rows, %d columns x 10 day window' % (len(df), len(COLUMNS)))
+    print('  groupby apply:    %8.3f ms' % Best(lambda: Legacy_States(df), 5))
+    print('  Roll_Means:       %8.3f ms' % Best(lambda: utils.Roll_Means(values, [10], groups=groups), 5))
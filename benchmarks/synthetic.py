@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Synthetic stand-in for the covidtracking states/daily.json payload, so the
+pipeline in utils.py can be timed offline.
+"""
+
+import datetime as dt
+import hashlib
+import json
+import random
+
+# the 50 states, DC and the territories the upstream reports
+STATES = ['AK', 'AL', 'AR', 'AS', 'AZ', 'CA', 'CO', 'CT', 'DC', 'DE', 'FL', 'GA', 'GU',
+          'HI', 'IA', 'ID', 'IL', 'IN', 'KS', 'KY', 'LA', 'MA', 'MD', 'ME', 'MI', 'MN',
+          'MO', 'MP', 'MS', 'MT', 'NC', 'ND', 'NE', 'NH', 'NJ', 'NM', 'NV', 'NY', 'OH',
+          'OK', 'OR', 'PA', 'PR', 'RI', 'SC', 'SD', 'TN', 'TX', 'UT', 'VA', 'VI', 'VT',
+          'WA', 'WI', 'WV', 'WY']
+
+# fields of the upstream records that Clean_Data drops or ignores
+UNUSED = ['probableCases', 'pending', 'totalTestResultsSource', 'hospitalizedCurrently',
+          'hospitalizedCumulative', 'onVentilatorCurrently', 'onVentilatorCumulative',
+          'recovered', 'lastUpdateEt', 'dateModified', 'checkTimeEt', 'hospitalizedDischarged',
+          'dateChecked', 'totalTestsViral', 'positiveTestsViral', 'negativeTestsViral',
+          'positiveCasesViral', 'totalTestEncountersViral', 'totalTestsPeopleViral',
+          'totalTestsAntibody', 'positiveTestsAntibody', 'negativeTestsAntibody',
+          'totalTestsPeopleAntibody', 'positiveTestsPeopleAntibody',
+          'negativeTestsPeopleAntibody', 'totalTestsPeopleAntigen',
+          'positiveTestsPeopleAntigen', 'totalTestsAntigen', 'positiveTestsAntigen', 'fips',
+          'posNeg', 'dataQualityGrade', 'commercialScore', 'negativeRegularScore',
+          'negativeScore', 'positiveScore', 'score', 'grade']
+
+
+def Regions(n=len(STATES)):
+    """n region codes, the states first and then made up ones for county sized payloads.
+    Clean_Data keeps only the states it has a population for, the rest are dropped there."""
+    
+    return STATES[:n] + ['R%05d' % i for i in range(max(0, n - len(STATES)))]
+
+
+def Daily_Records(days=400, states=STATES, end=dt.date(2021, 3, 7), seed=0, lean=False):
+    """Yield the records of each day in turn, oldest first, as one list per day.
+    lean leaves out the fields Clean_Data ignores, to keep large payloads small."""
+    
+    rnd = random.Random(seed)
+    start = end - dt.timedelta(days=days - 1)
+    
+    # states start reporting on different days, like the real data
+    first = {s: start + dt.timedelta(days=rnd.randint(0, min(40, days - 1))) for s in states}
+    totals = {s: dict(positive=0, negative=0, death=0, tests=0, icu=0) for s in states}
+    
+    for n in range(days) :
+        date = start + dt.timedelta(days=n)
+        records = []
+        for state in states :
+            if date < first[state] :
+                continue
+            
+            t = totals[state]
+            positive = max(0, int(rnd.gauss(300, 200)))
+            negative = max(0, int(rnd.gauss(3000, 1000)))
+            death = max(0, int(rnd.gauss(5, 4)))
+            
+            t['positive'] += positive
+            t['negative'] += negative
+            t['death'] += death
+            t['tests'] += positive + negative
+            t['icu'] += max(0, int(rnd.gauss(3, 3)))
+            
+            record = {} if lean else dict.fromkeys(UNUSED)
+            record.update({
+                'date': int(date.strftime('%Y%m%d')),
+                'state': state,
+                'positive': t['positive'],
+                'negative': t['negative'],
+                'totalTestResults': t['tests'],
+                'inIcuCurrently': rnd.randint(0, 100),
+                'inIcuCumulative': t['icu'],
+                'death': t['death'],
+                'hospitalized': None,
+                'deathConfirmed': t['death'],
+                'deathProbable': None,
+                'positiveIncrease': positive,
+                'negativeIncrease': negative,
+                'total': 0,
+                'totalTestResultsIncrease': positive + negative,
+                'deathIncrease': death,
+                'hospitalizedIncrease': 0,
+                })
+            if not lean :
+                record['hash'] = hashlib.sha1((state + str(date) + str(positive)).encode()).hexdigest()
+            records.append(record)
+        
+        yield records
+
+
+def Make_Payload(days=400, states=STATES, end=dt.date(2021, 3, 7), seed=0):
+    """Return a list of daily records shaped like the upstream API, newest date first"""
+    
+    return [record for records in reversed(list(Daily_Records(days, states, end, seed)))
+            for record in records]
+
+
+def Payload_Chunks(records, size=2**16):
+    """The records serialized like the upstream response body, in chunks of size bytes"""
+    
+    body = json.dumps(records).encode()
+    
+    return [body[i:i + size] for i in range(0, len(body), size)]
+
+
+def Payload_Body(days=400, states=STATES, end=dt.date(2021, 3, 7), seed=0, lean=False, size=2**16):
+    """Payload_Chunks(Make_Payload(...)) without holding every record at once, each day is
+    serialized as it is generated"""
+    
+    encoded = [json.dumps(records)[1:-1].encode()
+               for records in Daily_Records(days, states, end, seed, lean) if records]
+    body = b'[' + b', '.join(reversed(encoded)) + b']'
+    
+    return [body[i:i + size] for i in range(0, len(body), size)]
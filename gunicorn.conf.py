@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""
+gunicorn settings for serving app:server, used by the Procfile.
+
+    gunicorn app:server --config gunicorn.conf.py
+
+Callbacks never wait on the upstream API: each worker starts a refresher
+thread when it imports app, the refresh lock lets one of them fetch at a time,
+and every worker maps the same published data from COVID_STORE_DIR. What is
+left on the request path is reading a version token, slicing the shared data
+and building (or finding cached) figure JSON.
+
+Sizing:
+    workers  one per CPU core. The figure building is CPU bound Python, so the
+             GIL makes processes, not threads, the way to use more cores. A
+             worker costs about the interpreter plus its figure cache
+             (COVID_FIGURE_CACHE_MB, 64 MB by default), the data itself is
+             memory mapped and shared.
+    threads  4 per worker. Threads cover the time a request spends waiting on
+             the client or the disk, so a slow viewer does not hold a worker.
+             Much beyond 8 only adds GIL contention.
+Both can be overridden with WEB_CONCURRENCY and GUNICORN_THREADS.
+"""
+
+import multiprocessing
+import os
+
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+
+# not preloaded, the refresher thread has to be started in each worker, and
+# threads do not survive the fork from a preloaded master
+preload_app = False
+
+# requests only slice prepared data, anything this slow is stuck
+timeout = 30
+graceful_timeout = 30
+keepalive = 5
+
+bind = '0.0.0.0:' + os.environ.get('PORT', '8000')
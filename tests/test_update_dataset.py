@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Update_Dataset, the incremental refresh, has to give the same dataset as rebuilding
+everything from the new payload with Build_Dataset.
+"""
+
+import copy
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import utils
+from synthetic import Make_Payload, Payload_Chunks
+
+
+def Parse(records):
+    return utils.Parse_Records(Payload_Chunks(records))
+
+
+def Revise(records, revisions):
+    """A copy of records with positiveIncrease of each (state, date) in revisions raised"""
+    
+    records = copy.deepcopy(records)
+    for record in records :
+        if (record['state'], record['date']) in revisions :
+            record['positiveIncrease'] += 100
+            record['inIcuCumulative'] = (record['inIcuCumulative'] or 0) + 10
+    
+    return records
+
+
+def Assert_Same(full, incremental):
+    
+    a = full['df'].astype({'state': object})
+    b = incremental['df'].astype({'state': object})
+    pd.testing.assert_frame_equal(a, b, check_dtype=False)
+    
+    for key in ('values', 'means', 'first', 'last') :
+        np.testing.assert_allclose(full['roll'][key], incremental['roll'][key])
+    assert full['roll']['dates'].equals(incremental['roll']['dates'])
+    
+    for key in ('cases', 'tests') :
+        np.testing.assert_allclose(full['hotspots'][key], incremental['hotspots'][key])
+    
+    pd.testing.assert_frame_equal(full['aggregates'], incremental['aggregates'])
+    assert full['national'] == incremental['national']
+
+
+def Check(old, new):
+    
+    old, new = Parse(old), Parse(new)
+    base = utils.Build_Dataset(utils.Clean_Data(old))
+    changed = utils.Clean_Data(utils.Diff_Records(old, new))
+    assert len(changed)
+    
+    Assert_Same(utils.Build_Dataset(utils.Clean_Data(new)), utils.Update_Dataset(base, changed))
+
+
+@pytest.fixture(scope='module')
+def records():
+    return Make_Payload(120)
+
+
+def test_new_days(records):
+    Check([r for r in records if r['date'] < 20210301], records)
+
+
+def test_revised_history(records):
+    Check(records, Revise(records, {('UT', 20210201), ('NJ', 20201225)}))
+
+
+def test_new_days_and_revisions(records):
+    Check([r for r in records if r['date'] < 20210301], Revise(records, {('UT', 20210201)}))
+
+
+def test_each_state_revising_a_different_day():
+    # every state's earliest changed day differs, the state to date mapping is one to one
+    records = Make_Payload(60, states=['NY', 'UT'])
+    Check(records, Revise(records, {('NY', 20210201), ('UT', 20210215)}))
+
+
+def test_new_state_on_the_new_days(records):
+    # a state reporting for the first time on a new day grows the state axis of the cube
+    # and the hotspots
+    old = [r for r in records if r['date'] < 20210301 and r['state'] != 'UT']
+    Check(old, [r for r in records if r['state'] != 'UT' or r['date'] >= 20210301])
@@ -12,13 +12,35 @@ import dash
 import dash_core_components as dcc
 import dash_html_components as html
 import plotly.graph_objects as go
+import plotly.io as pio
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.feather as feather
 import requests
 import datetime as dt
+import base64
+import bisect
+import codecs
+import collections
+import fcntl
+import flask
+import functools
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import types
+import time
 from plotly.graph_objs.scatter.marker import Line
 
 
-from plotly.subplots import make_subplots
+
+logger = logging.getLogger(__name__)
 
 color = {
     '7-day': 'Black',
@@ -39,69 +61,389 @@ color = {
 def Make_Update():
     
     return [html.P('Last Updated: ' + str(dt.datetime.now().strftime("%m/%d/%y %H:%M (MT)")))]
-#%%  Load the data from covidtracking API
 
 
-def Get_Data():
+def Placeholder_Figure(text='Loading data...'):
+    """Empty figure shown until the first data version is available"""
     
-   
+    return {'data': [],
+            'layout': {'xaxis': {'visible': False},
+                       'yaxis': {'visible': False},
+                       'annotations': [{'text': text,
+                                        'showarrow': False,
+                                        'font': {'size': 24}}]}}
+#%%  Stage timings, as Prometheus histograms on /metrics and Server-Timing headers on callbacks
+
+# off unless COVID_METRICS=1, and then Timed hands back the functions undecorated
+METRICS_ENABLED = os.environ.get('COVID_METRICS', '0') == '1'
+
+class Histogram :
+    """Prometheus histogram of one metric, with a series for each value of its label"""
     
-    url = 'https://covidtracking.com/api/v1/states/daily.json'
+    def __init__(self, name, help, label, buckets):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = list(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
     
-    r = requests.get(url)
+    def observe(self, label, value):
+        i = bisect.bisect_left(self.buckets, value)
+        
+        with self._lock :
+            # a count per bucket, one for +Inf and the sum of the values last
+            series = self._series.setdefault(label, [0] * (len(self.buckets) + 1) + [0.0])
+            series[i] += 1
+            series[-1] += value
+    
+    def exposition(self):
+        """The histogram in the Prometheus text format, with cumulative buckets"""
+        
+        with self._lock :
+            series = {label: list(counts) for label, counts in self._series.items()}
+        
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        for label, counts in sorted(series.items()) :
+            labels = '%s="%s"' % (self.label, Label_Value(label))
+            total = 0
+            for le, n in zip(self.buckets + ['+Inf'], counts[:-1]) :
+                total += n
+                lines.append('%s_bucket{%s,le="%s"} %d' % (self.name, labels, le, total))
+            lines.append('%s_sum{%s} %r' % (self.name, labels, counts[-1]))
+            lines.append('%s_count{%s} %d' % (self.name, labels, total))
+        
+        return '\n'.join(lines)
+
+
+def Label_Value(value):
+    """value escaped for a label in the Prometheus text format"""
     
-    json_data = r.json()
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+STAGE_SECONDS = Histogram('covid_stage_seconds', 'Duration of each stage of a data refresh and of each figure builder.',
+                          'stage', [.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60])
+STAGE_ROWS = Histogram('covid_stage_rows', 'Rows coming out of each stage of a data refresh.',
+                       'stage', [10**k for k in range(8)])
+PAYLOAD_BYTES = Histogram('covid_payload_bytes', 'Size of the upstream payload and of each figure JSON.',
+                          'payload', [2**k for k in range(10, 31, 2)])
+CALLBACK_SECONDS = Histogram('covid_callback_seconds', 'Duration of each Dash callback request.',
+                             'callback', STAGE_SECONDS.buckets)
+
+
+def Timed(stage, rows=None):
+    """Decorator recording the duration of each call as stage, and rows(result) as the number
+    of rows it produced. With metrics off the function is returned as it is."""
     
-    df = pd.json_normalize(json_data)
+    def decorate(func):
+        if not METRICS_ENABLED :
+            return func
+        
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            result = func(*args, **kwargs)
+            Observe(stage, time.perf_counter() - start)
+            if rows is not None and result is not None :
+                STAGE_ROWS.observe(stage, rows(result))
+            return result
+        
+        return timed
     
-    ### Add calculate various relations of the data and add them as columns
+    return decorate
+
+
+def Observe(stage, seconds):
+    """Record a stage duration, also for the Server-Timing header when serving a request"""
     
-    df['DperP'] = df['death']/df['positive']  # Add columns Deaths per Positive case (DperP), Positive per Test (PosPerTest),  
+    STAGE_SECONDS.observe(stage, seconds)
     
-    df['PosPerTest']= df['positiveIncrease']/df['totalTestResultsIncrease']*100  # Positives per test in percentage
+    if flask.has_request_context() :
+        flask.g.setdefault('server_timing', []).append((stage, seconds))
+
+
+def Observe_Size(payload, size):
     
-    df['date'] = pd.to_datetime(df['date'], format = '%Y%m%d') #convert date to datetime object and set as index
-    df.set_index('date')
+    if METRICS_ENABLED :
+        PAYLOAD_BYTES.observe(payload, size)
+
+
+def Counted(chunks, payload):
+    """Pass chunks through, recording their total size as payload once they run out"""
     
-    df = df[df['date'] >= '2020-03-01']
-    # Drop all unused columns. 
+    size = 0
+    for chunk in chunks :
+        size += len(chunk)
+        yield chunk
+    
+    Observe_Size(payload, size)
+
+
+def Install_Metrics(server, callbacks=()):
+    """Serve the histograms and the figure cache counters on /metrics and add Server-Timing
+    headers to responses of the Flask server, if metrics are on. Every worker process keeps
+    and serves its own metrics.
+    callbacks are the outputs of the app's callbacks, e.g. app.callback_map, anything else a
+    client posts is counted as "unknown"."""
+    
+    if not METRICS_ENABLED :
+        return
+    
+    @server.before_request
+    def start_timing():
+        flask.g.request_start = time.perf_counter()
+    
+    @server.after_request
+    def server_timing(response):
+        elapsed = time.perf_counter() - flask.g.get('request_start', time.perf_counter())
+        
+        if flask.request.path.endswith('_dash-update-component') :
+            body = flask.request.get_json(silent=True)
+            output = body.get('output') if isinstance(body, dict) else None
+            # the label comes from the client, only known callbacks get a series of their own
+            CALLBACK_SECONDS.observe(output if isinstance(output, str) and output in callbacks else 'unknown', elapsed)
+        
+        stages = flask.g.get('server_timing', [])
+        if stages :
+            response.headers['Server-Timing'] = ', '.join(
+                ['%s;dur=%.2f' % (stage, seconds * 1000) for stage, seconds in stages]
+                + ['total;dur=%.2f' % (elapsed * 1000)])
+        
+        return response
+    
+    @server.route('/metrics')
+    def metrics():
+        body = '\n'.join(h.exposition() for h in [STAGE_SECONDS, STAGE_ROWS, PAYLOAD_BYTES, CALLBACK_SECONDS,
+                                                    FIGURE_CACHE])
+        return flask.Response(body + '\n', mimetype='text/plain; version=0.0.4')
+
+#%%  Load the data from covidtracking API
+
+
+DATA_URL = os.environ.get('COVID_DATA_URL', 'https://covidtracking.com/api/v1/states/daily.json')
+
+# daily increase columns derived here, and the cumulative column each one is the difference of
+INCREASES = {'icuIncrease': 'inIcuCumulative'}
+
+# the fields kept from each upstream record and their column types, everything else in the
+# payload is skipped while parsing. Upstream leaves the cumulative and ICU fields null on
+# days a state did not report them, so those are float with NaN for missing. float32 holds
+# counts exactly up to 2**24, the test totals go past that.
+RECORD_SCHEMA = {
+    'date': 'datetime64[ns]', # YYYYMMDD upstream
+    'state': 'category',
+    'positive': 'float32',
+    'death': 'float32',
+    'totalTestResults': 'float64',
+    'inIcuCurrently': 'float32',
+    'inIcuCumulative': 'float32',
+    'positiveIncrease': 'int32',
+    'deathIncrease': 'int32',
+    'totalTestResultsIncrease': 'int32',
+    }
+
+@Timed('get_data')
+def Get_Data():
     
-    drop = ['pending',
-            'hospitalizedCurrently', 'hospitalizedCumulative', 'onVentilatorCurrently',
-            'onVentilatorCumulative','recovered', 'dataQualityGrade', 'lastUpdateEt',
-            'dateModified','checkTimeEt', 'dateChecked','totalTestsViral', 'positiveTestsViral',
-            'negativeTestsViral','positiveCasesViral', 'fips','posNeg','hash', 'commercialScore',
-            'negativeRegularScore', 'negativeScore', 'positiveScore', 'score','grade']
+    return Clean_Data(Fetch_Records()['columns'])
+
+
+UNAVAILABLE = 'unavailable' # Fetch_Records' answer when the upstream can't be reached
+
+@Timed('fetch')
+def Fetch_Records(snapshot=None):
+    """Return the upstream payload as {'columns', 'etag', 'last_modified'}, or None if it
+    has not changed since snapshot. The response is parsed by Parse_Records as it streams in.
     
-    df.drop(columns=drop, inplace=True)
+    Given a snapshot the request is conditional on its ETag/Last-Modified, and if the
+    upstream is unreachable UNAVAILABLE is returned, so the snapshot can stand in for it."""
     
+    headers = {}
+    if snapshot is not None :
+        if snapshot['etag'] :
+            headers['If-None-Match'] = snapshot['etag']
+        if snapshot['last_modified'] :
+            headers['If-Modified-Since'] = snapshot['last_modified']
+    
+    try :
+        with requests.get(DATA_URL, headers=headers, timeout=60, stream=True) as r :
+            r.raise_for_status()
+            if r.status_code == 304 :
+                return None
+            
+            chunks = r.iter_content(2**16)
+            if METRICS_ENABLED :
+                chunks = Counted(chunks, 'upstream')
+            
+            return {'columns': Parse_Records(chunks),
+                    'etag': r.headers.get('ETag'),
+                    'last_modified': r.headers.get('Last-Modified')}
+    except requests.RequestException :
+        if snapshot is None :
+            raise
+        logger.warning('Upstream unavailable, using the snapshot from %s', snapshot['last_date'])
+        return UNAVAILABLE
+
+
+_SEPARATOR = re.compile(r'[\s,\[\]]*')
+
+@Timed('parse', rows=lambda columns: len(columns['date']))
+def Parse_Records(chunks, schema=RECORD_SCHEMA, size=2**14):
+    """Parse a JSON array of upstream records, given as an iterable of byte chunks, into one
+    typed array per field of schema. Records are decoded one at a time and written into
+    preallocated columns, so the payload is never held as Python objects."""
+    
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    
+    # dates are kept as YYYYMMDD and states as codes until the end
+    buffers = {field: np.empty(size, 'int32' if dtype == 'datetime64[ns]' else
+                                     'int16' if dtype == 'category' else dtype)
+               for field, dtype in schema.items()}
+    ints = [field for field, dtype in schema.items() if dtype.startswith('int')]
+    floats = [field for field, dtype in schema.items() if dtype.startswith('float')]
+    dates = [field for field, dtype in schema.items() if dtype == 'datetime64[ns]']
+    codes = {field: {} for field, dtype in schema.items() if dtype == 'category'}
+    
+    buf, pos, n = '', 0, 0
+    for chunk in chunks :
+        buf = buf[pos:] + text.decode(chunk)
+        pos = 0
         
-    # clean up bad data point, I found the actual number from NJ.gov website (was 1877)
-    df.loc[(df['date']=='2020-06-25') & (df['state']=='NJ'),'deathIncrease']=23
+        while True :
+            pos = _SEPARATOR.match(buf, pos).end()
+            try :
+                record, end = decoder.raw_decode(buf, pos)
+            except ValueError :
+                break # the rest of the record is in the next chunk
+            pos = end
+            
+            if n == size :
+                size *= 2
+                buffers = {field: np.resize(column, size) for field, column in buffers.items()}
+            
+            for field in dates :
+                buffers[field][n] = record[field]
+            for field, seen in codes.items() :
+                buffers[field][n] = seen.setdefault(record[field], len(seen))
+            for field in ints :
+                # upstream reports no change as 0, a missing increase is taken the same way
+                buffers[field][n] = record.get(field) or 0
+            for field in floats :
+                value = record.get(field)
+                buffers[field][n] = np.nan if value is None else value
+            n += 1
+    
+    if buf[_SEPARATOR.match(buf, pos).end():] or text.decode(b'', final=True) :
+        raise ValueError('Malformed records payload at: ' + buf[pos:pos + 80])
+    
+    columns = {field: column[:n] for field, column in buffers.items()}
+    for field in dates :
+        day = columns[field]
+        months = (day // 10000 - 1970) * 12 + day // 100 % 100 - 1
+        columns[field] = (months.astype('datetime64[M]').astype('datetime64[D]')
+                          + (day % 100 - 1)).astype('datetime64[ns]')
+    for field, seen in codes.items() :
+        categories = np.array(list(seen), dtype=object)
+        order = np.argsort(categories)
+        remap = np.empty(len(order), 'int16')
+        remap[order] = np.arange(len(order))
+        columns[field] = pd.Categorical.from_codes(remap[columns[field]], categories[order])
+    
+    return columns
+
+
+@Timed('diff', rows=lambda columns: len(columns['date']))
+def Diff_Records(old, new):
+    """The rows of the columns new that are not in old, or differ from the old row of the same
+    state and date. Only the fields kept by Parse_Records are compared."""
+    
+    def fingerprint(columns):
+        return pd.util.hash_pandas_object(pd.DataFrame({field: columns[field] for field in new}),
+                                          index=False).to_numpy()
+    
+    keep = ~np.isin(fingerprint(new), fingerprint(old))
+    
+    return {field: column[keep] for field, column in new.items()}
+
+
+def Snapshot_Path():
+    return os.path.join(STORE_DIR, 'snapshot.npz')
+
+
+@Timed('snapshot.load')
+def Load_Snapshot(schema=RECORD_SCHEMA):
+    """The last upstream payload saved by Save_Snapshot, or None"""
+    
+    try :
+        with np.load(Snapshot_Path(), allow_pickle=False) as f :
+            columns = {field: pd.Categorical.from_codes(f[field], f[field + '.categories'])
+                       if dtype == 'category' else f[field] for field, dtype in schema.items()}
+            return {'columns': columns,
+                    'etag': str(f['etag']) or None,
+                    'last_modified': str(f['last_modified']) or None,
+                    'last_date': str(f['last_date'])}
+    except (OSError, ValueError, KeyError) :
+        return None
+
+
+@Timed('snapshot.save')
+def Save_Snapshot(payload):
+    """Save a payload from Fetch_Records as the snapshot the next refresh is compared to"""
+    
+    arrays = {'etag': np.array(payload['etag'] or ''),
+              'last_modified': np.array(payload['last_modified'] or ''),
+              'last_date': np.array(str(payload['columns']['date'].max())[:10])}
+    for field, column in payload['columns'].items() :
+        if isinstance(column, pd.Categorical) :
+            arrays[field] = column.codes
+            arrays[field + '.categories'] = np.asarray(column.categories, dtype=str)
+        else :
+            arrays[field] = column
+    
+    os.makedirs(STORE_DIR, exist_ok=True)
+    tmp = Snapshot_Path() + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp, 'wb') as f :
+        np.savez_compressed(f, **arrays)
+    os.replace(tmp, Snapshot_Path())
+
+
+# bad upstream data points, and the value that replaces each of them. One row per state, date
+# and column, a later row for the same point replaces an earlier one.
+CORRECTIONS = pd.DataFrame([
+    ('NJ', '2020-06-25', 'deathIncrease', 23), # actual number from the NJ.gov website (was 1877)
+    ('RI', '2020-08-08', 'positiveIncrease', 0),
+    ('RI', '2020-08-10', 'positiveIncrease', 196),
+    ('WI', '2020-08-26', 'positiveIncrease', 768),
+    ], columns=['state', 'date', 'column', 'value']).astype({'date': 'datetime64[ns]'}).drop_duplicates(
+        ['state', 'date', 'column'], keep='last')
+
+# columns that shouldn't have negative values
+NON_NEGATIVE = ['positive', 'inIcuCurrently', 'inIcuCumulative', 'death', 'positiveIncrease',
+                'totalTestResults', 'totalTestResultsIncrease', 'deathIncrease', 'DperP', 'PosPerTest']
+
+@Timed('clean', rows=len)
+def Clean_Data(columns):
+    """Build the cleaned frame used by the figures from the columns Parse_Records reads"""
+    
+    df = pd.DataFrame(columns)
+    
+    ### Add calculate various relations of the data and add them as columns
+    
+    df['DperP'] = df['death']/df['positive']  # Add columns Deaths per Positive case (DperP), Positive per Test (PosPerTest),  
     
-    #clean up bad data point in RI 
-    df.loc[(df['date']=='2020-08-08') & (df['state']=='RI'),'positiveIncrease']=0
-    df.loc[(df['date']=='2020-08-10') & (df['state']=='RI'),'positiveIncrease']=196
-    #Bad Data Point 8-26 in WI
-    df.loc[(df['date']=='2020-08-26') & (df['state']=='WI'),'positiveIncrease']=768
+    df['PosPerTest']= df['positiveIncrease']/df['totalTestResultsIncrease']*100  # Positives per test in percentage
     
-    #list columns that shouldn't have negative values
-    greater_than_zero = ['positive', 'negative', 'inIcuCurrently',
-           'inIcuCumulative', 'death', 'hospitalized', 'deathConfirmed',
-           'deathProbable', 'positiveIncrease', 'negativeIncrease', 'total',
-           'totalTestResults', 'totalTestResultsIncrease', 'deathIncrease',
-           'hospitalizedIncrease', 'DperP', 'PosPerTest']
+    df = df[df['date'] >= '2020-03-01']
     
-    # Replace negative value with 0
-    for item in greater_than_zero :
-        df[item].clip(lower=0,inplace=True)
+    df = Apply_Corrections(df)
     
+    # Replace negative values with 0, every column in one assign
+    df = df.assign(**{item: np.maximum(df[item].to_numpy(), 0) for item in NON_NEGATIVE})
     
-    df['yadda'] = df['inIcuCumulative'].shift(-1)
     
-    # iterate through the rows to calculate daily increase in ICU cases
-    for row in df.iterrows() :
-        df['icuIncrease'] = df['inIcuCumulative'] - df['yadda']
+    df = Daily_Increase(df)
         
     df= States_Won(df)
     df= State_Pop(df)
@@ -110,371 +452,1265 @@ def Get_Data():
     
     return df
 
-#%%
 
-def Roll_Avg(df, col, interval,shift = True) :
-    """Calculate the rolling averages of interval duration of columns in df"""
-    length = len(interval)
+def Apply_Corrections(df, corrections=CORRECTIONS):
+    """df with the values in corrections set, matched to its rows on state and date. Each
+    corrected column is one hash join of the rows against an index of its corrections, so
+    the cost grows with the rows and hardly with the number of corrections."""
+    
+    states = df['state'].cat
+    rows = Day_Keys(states.codes.to_numpy(), df['date'])
+    
+    # corrections of states not in df have nothing to correct
+    codes = states.categories.get_indexer(corrections['state'])
+    keys = Day_Keys(codes, corrections['date'])
+    columns = corrections['column'].to_numpy()
+    values = corrections['value'].to_numpy()
     
-    for n in range(length) :
-        # make new col called roll_col_interval
-        new_col = 'roll_' + str(col) + '_'+ str(interval[n])
-        if shift == False :
-            df[new_col] = df.loc[:,col].rolling(interval[n]).mean()
+    fixed = {}
+    for column in pd.unique(columns) :
+        mine = (columns == column) & (codes >= 0)
+        found = pd.Index(keys[mine]).get_indexer(rows)
+        hit = found >= 0
         
+        if hit.any() :
+            fixed[column] = df[column].to_numpy(copy=True)
+            fixed[column][hit] = values[mine][found[hit]]
+    
+    return df.assign(**fixed) if fixed else df
+
+
+def Day_Keys(codes, dates):
+    """(state code, date) pairs packed into one int64 each, cheaper to hash than a MultiIndex"""
+    
+    days = np.asarray(dates, dtype='datetime64[D]').astype(np.int64)
+    
+    return np.asarray(codes, dtype=np.int64) << 32 | days
+
+
+@Timed('clean.Daily_Increase')
+def Daily_Increase(df, increases=INCREASES):
+    """Add the day over day difference of each cumulative column, taken per state in date order
+    so a state's first day is never differenced against another state"""
+    
+    # one sort and one grouped diff for the whole block of columns
+    ordered = df.sort_values(['state', 'date'])
+    diffs = ordered.groupby('state')[list(increases.values())].diff()
+    diffs.columns = list(increases.keys())
+    
+    # index alignment puts the differences back on the original rows
+    return df.assign(**{col: diffs[col] for col in diffs.columns})
+
+#%%  Server-side store for the cleaned data, keyed by a small version token.
+#    Each version is a directory of memory mappable files shared by every worker.
+
+STORE_DIR = os.environ.get('COVID_STORE_DIR', os.path.join(tempfile.gettempdir(), 'covid_dashboard'))
+STORE_KEEP = 3 # number of versions kept in memory and on disk
+STORE_FORMAT = 3 # layout of Write_Dataset's files, bump it whenever they change
+
+_store = {}
+_store_lock = threading.Lock() # request threads load and prune versions concurrently
+
+@Timed('store')
+def Store_Data(data):
+    """Write the dataset from Build_Dataset to the store and return the version token
+    the browser carries instead of the data"""
+    
+    # the same data written in another layout or with figures rendered by other code is another
+    # version, so a deploy never maps what an older one left in STORE_DIR
+    digest = hashlib.md5(pd.util.hash_pandas_object(data['df'], index=False).values)
+    digest.update(str(STORE_FORMAT).encode())
+    digest.update(RENDER_VERSION.encode())
+    version = digest.hexdigest()[:12]
+    data['version'] = version
+    
+    os.makedirs(STORE_DIR, exist_ok=True)
+    path = os.path.join(STORE_DIR, version)
+    
+    if os.path.isdir(path) :
+        try :
+            Read_Dataset(path)
+            # reused, so it is the newest version as far as Prune_Store's mtime order goes
+            os.utime(path)
+        except (OSError, ValueError, KeyError) :
+            # files removed by a tmp cleaner, write the version again
+            shutil.rmtree(path, ignore_errors=True)
+    
+    if not os.path.isdir(path) :
+        # write under a temporary name and rename, so other workers never see a partial version
+        tmp = path + '.' + str(os.getpid()) + '.tmp'
+        Write_Dataset(data, tmp)
+        try :
+            os.rename(tmp, path)
+        except OSError :
+            # another worker stored the same version first
+            shutil.rmtree(tmp, ignore_errors=True)
+    
+    # read it back memory mapped, so this worker shares the pages with all the others
+    dataset = Read_Dataset(path)
+    with _store_lock :
+        _store[version] = dataset
+    Prune_Store()
+    
+    return version
+
+
+@Timed('load')
+def Load_Data(version):
+    """Return the dataset stored under version, mapping it from disk if another worker stored it"""
+    
+    if not re.fullmatch('[0-9a-f]{12}', str(version)) :
+        raise KeyError('Unknown data version: ' + str(version))
+    
+    with _store_lock :
+        dataset = _store.get(version)
+    
+    if dataset is None :
+        path = os.path.join(STORE_DIR, version)
+        if not os.path.isdir(path) :
+            raise KeyError('Unknown data version: ' + version)
+        try :
+            dataset = Read_Dataset(path)
+        except (OSError, ValueError, KeyError) as e :
+            # removed while reading, or written by another layout
+            raise KeyError('Unreadable data version: ' + version) from e
+        with _store_lock :
+            _store[version] = dataset
+        Prune_Store()
+        
+        # another worker published this version, figures of older ones are not needed anymore
+        if version == Current_Version() :
+            FIGURE_CACHE.invalidate(version)
+    
+    # returned from the local, another thread may have pruned it from _store by now
+    return dataset
+
+
+def Write_Dataset(data, path):
+    """Save a dataset as an uncompressed Feather file for the frame, .npy files for the
+    rolling cube and a JSON file for the rest, all of which Read_Dataset can map"""
+    
+    os.makedirs(path)
+    
+    df = data['df']
+    columns = []
+    for col in df.columns :
+        if df[col].dtype == object or isinstance(df[col].dtype, pd.CategoricalDtype) :
+            # strings become dictionary encoded and load as categoricals
+            columns.append(pa.array(df[col].astype('category')))
         else :
-            df[new_col] = df.loc[:,col].rolling(interval[n]).mean().shift(periods= - interval[n])
-            
-#%%            
+            # from_pandas=False keeps NaN as a float instead of an Arrow null, so the
+            # column can be read back without a copy
+            columns.append(pa.array(df[col].to_numpy(), from_pandas=False))
+    feather.write_feather(pa.Table.from_arrays(columns, names=list(df.columns)),
+                          os.path.join(path, 'df.feather'), compression='uncompressed')
+    
+    roll = data['roll']
+    for name in ['values', 'means', 'first', 'last'] :
+        np.save(os.path.join(path, 'roll_' + name + '.npy'), roll[name])
+    np.save(os.path.join(path, 'population.npy'), data['population'])
+    for name in ['cases', 'tests'] :
+        np.save(os.path.join(path, 'hotspots_' + name + '.npy'), data['hotspots'][name])
+    
+    # Feather takes flat column names, (metric, group) is written as 'metric|group'
+    aggregates = data['aggregates'].set_axis(['|'.join(col) for col in data['aggregates'].columns], axis=1)
+    feather.write_feather(aggregates.reset_index(), os.path.join(path, 'aggregates.feather'),
+                          compression='uncompressed')
+    
+    meta = {'format': STORE_FORMAT,
+            'version': data['version'],
+            'national': data['national'],
+            'hotspots_date': str(data['hotspots']['date'].date()),
+            'roll': {'states': list(roll['states']),
+                     'start': str(roll['dates'][0].date()),
+                     'days': len(roll['dates']),
+                     'metrics': roll['metrics'],
+                     'windows': roll['windows']}}
+    with open(os.path.join(path, 'meta.json'), 'w') as f :
+        json.dump(meta, f)
+
+
+def Read_Dataset(path):
+    """Map a dataset written by Write_Dataset. The frame's numeric columns, the aggregates
+    and the cube are read-only views of the files, not copies, and the bundle itself is a
+    read-only mapping, so callbacks on any thread can share it without locking."""
+    
+    with open(os.path.join(path, 'meta.json')) as f :
+        meta = json.load(f)
+    
+    if meta.get('format') != STORE_FORMAT :
+        raise ValueError('Dataset at %s is in format %s, not %s' % (path, meta.get('format'), STORE_FORMAT))
+    
+    table = feather.read_table(os.path.join(path, 'df.feather'), memory_map=True)
+    
+    sums = feather.read_table(os.path.join(path, 'aggregates.feather'), memory_map=True)
+    aggregates = sums.drop(['date']).to_pandas(split_blocks=True)
+    aggregates.index = pd.DatetimeIndex(sums.column('date').to_numpy(), name='date')
+    aggregates.columns = pd.MultiIndex.from_tuples([tuple(col.split('|')) for col in aggregates.columns])
+    
+    roll = {'states': np.array(meta['roll']['states']),
+            'dates': pd.date_range(meta['roll']['start'], periods=meta['roll']['days'], freq='D'),
+            'metrics': meta['roll']['metrics'],
+            'windows': meta['roll']['windows']}
+    for name in ['values', 'means', 'first', 'last'] :
+        roll[name] = np.load(os.path.join(path, 'roll_' + name + '.npy'), mmap_mode='r')
+    
+    hotspots = {'date': pd.Timestamp(meta['hotspots_date']),
+                'cases': np.load(os.path.join(path, 'hotspots_cases.npy'), mmap_mode='r'),
+                'tests': np.load(os.path.join(path, 'hotspots_tests.npy'), mmap_mode='r')}
+    
+    return types.MappingProxyType({
+            'version': meta['version'],
+            'df': table.to_pandas(split_blocks=True),
+            'roll': types.MappingProxyType(roll),
+            'population': np.load(os.path.join(path, 'population.npy'), mmap_mode='r'),
+            'hotspots': types.MappingProxyType(hotspots),
+            'aggregates': aggregates,
+            'national': types.MappingProxyType(meta['national'])})
+
+
+def Prune_Store():
+    """Drop all but the newest STORE_KEEP versions from memory and disk. Workers still
+    mapping a removed version keep their view of it until they drop it too."""
+    
+    with _store_lock :
+        while len(_store) > STORE_KEEP :
+            del _store[next(iter(_store))]
+    
+    versions = []
+    for name in os.listdir(STORE_DIR) :
+        if re.fullmatch('[0-9a-f]{12}', name) :
+            path = os.path.join(STORE_DIR, name)
+            try :
+                versions.append((os.path.getmtime(path), path))
+            except OSError :
+                # removed by another thread or worker pruning at the same time
+                pass
+    versions.sort()
+    for _, path in versions[:-STORE_KEEP] :
+        shutil.rmtree(path, ignore_errors=True)
+
+#%%  Cache of serialized figures, keyed by the data version they were built from
+
+class FigureCache :
+    """LRU of figure JSON strings, bounded by their total size in bytes"""
+    
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._figures = collections.OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key, build):
+        """Return the JSON cached under key, calling build() for it on a miss.
+        The version of the data must be key[1]."""
+        
+        with self._lock :
+            if key in self._figures :
+                self.hits += 1
+                self._figures.move_to_end(key)
+                return self._figures[key]
+            self.misses += 1
+        
+        # build outside the lock, two threads missing the same key just both build it
+        figure = build()
+        
+        with self._lock :
+            if key not in self._figures :
+                self._figures[key] = figure
+                self.size += len(figure)
+            while self.size > self.max_bytes and self._figures :
+                self.size -= len(self._figures.popitem(last=False)[1])
+        
+        return figure
+    
+    def invalidate(self, version):
+        """Drop every figure not built from version"""
+        
+        with self._lock :
+            for key in [key for key in self._figures if key[1] != version] :
+                self.size -= len(self._figures.pop(key))
+    
+    def stats(self):
+        with self._lock :
+            return {'hits': self.hits, 'misses': self.misses,
+                    'figures': len(self._figures), 'bytes': self.size}
+    
+    def exposition(self):
+        """The counters in the Prometheus text format, for /metrics"""
+        
+        stats = self.stats()
+        metrics = [('covid_figure_cache_hits_total', 'counter', 'Figure cache lookups that found the figure.', 'hits'),
+                   ('covid_figure_cache_misses_total', 'counter', 'Figure cache lookups that built the figure.', 'misses'),
+                   ('covid_figure_cache_figures', 'gauge', 'Figures in the figure cache.', 'figures'),
+                   ('covid_figure_cache_bytes', 'gauge', 'Size of the figures in the figure cache.', 'bytes')]
+        
+        lines = []
+        for name, kind, help, key in metrics :
+            lines += ['# HELP %s %s' % (name, help), '# TYPE %s %s' % (name, kind), '%s %d' % (name, stats[key])]
+        
+        return '\n'.join(lines)
 
-# Define function to do the subsetting of the data of selected state
-def State_Subset(df,state_abbrev, start_date = '2020-03-01') :
-    new_df = state_abbrev
-    new_df = df[df['state']== state_abbrev]
-    new_df = new_df[new_df['date']>= start_date]
+
+FIGURE_CACHE = FigureCache(int(os.environ.get('COVID_FIGURE_CACHE_MB', 64)) * 2**20)
+
+def Cached_Figure(builder, data, *args):
+    """builder(data, *args) as a figure dict, built at most once per data version and args"""
+    
+    key = (builder.__name__, data['version']) + args
     
-    return new_df
+    return json.loads(FIGURE_CACHE.get(key, lambda: Figure_JSON(builder(data, *args))))
 
+#%%  Background refresher, one fetch per interval shared by every worker on the machine
 
+REFRESH_INTERVAL = int(os.environ.get('COVID_REFRESH_INTERVAL', 3600)) # seconds between upstream fetches
+REFRESH_POLL = 60 # seconds between checks whether the published data is stale
 
+def Current_Version():
+    """Return the version token of the last published data, or None if nothing is published yet"""
+    
+    try :
+        with open(os.path.join(STORE_DIR, 'current')) as f :
+            return f.read().strip() or None
+    except OSError :
+        return None
 
-#%%
 
-def Make_Test_Plot(df,state_of_choice) :
-    
-    
-    #subset the state of interest
-    new_df = State_Subset(df,state_of_choice)
-    
-    interval = [7,20]#sets the intervals for the rolling averages
-    
-    ## Calculate the ROlling averages of features of interest
-    Roll_Avg(new_df,'positiveIncrease',interval)
-    Roll_Avg(new_df,'deathIncrease',interval)
-    Roll_Avg(new_df,'PosPerTest',interval)
-    Roll_Avg(new_df,'totalTestResultsIncrease',interval)
-    
-    #Create Plotly figure objects
-    fig = go.Figure()
-    fig = make_subplots(specs=[[{"secondary_y": True}]])#secondary y scale for infection rate
-    
-    # Add barplot of total tests per day
-    fig.add_trace(
-        go.Bar(x=new_df['date'],
-               y=new_df['totalTestResultsIncrease'],
-               marker=dict(color=color['Bar']),
-               name='Total Tests',
-               legendgroup = 'Tests',
-               offsetgroup=0
-               ),
-        secondary_y=False
-               
-    )
-    
-    # Add barplotof positive tests per day
-    fig.add_trace(
-        go.Bar(x=new_df['date'],
-               y=new_df['positiveIncrease'],
-               marker=dict(color=color['Bar2']),
-               name='Positive Tests',
-               offsetgroup=0,
-               legendgroup = 'Cases'
-               ),
-        secondary_y=False
-               
-    )
-    
-    #Rolling average trace of testing 
-    fig.add_trace(
-        go.Line(x=new_df['date'],
-                y=new_df['roll_totalTestResultsIncrease_7'],
-                marker=dict(color='Black'),
-                line=dict(width=2),
-                name='7-Day Average',
-                legendgroup = 'Tests'
-                ),
-        secondary_y=False
-                
+def Publish_Data(data):
+    """Store the dataset from Build_Dataset or Update_Dataset and point every worker at it"""
+    
+    version = Store_Data(data)
+    
+    path = os.path.join(STORE_DIR, 'current')
+    tmp = path + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp, 'w') as f :
+        f.write(version)
+    os.replace(tmp, path)
+    
+    FIGURE_CACHE.invalidate(version)
+    
+    return version
+
+
+def Data_Age():
+    """Seconds since data was last published, infinite if it never was"""
+    
+    try :
+        return time.time() - os.path.getmtime(os.path.join(STORE_DIR, 'current'))
+    except OSError :
+        return float('inf')
+
+
+@Timed('refresh')
+def Refresh_Data(wait=False):
+    """Fetch and publish new data if it is stale and no other worker is already doing it.
+    With wait=True block until the worker holding the lock is done instead of skipping."""
+    
+    os.makedirs(STORE_DIR, exist_ok=True)
+    
+    with open(os.path.join(STORE_DIR, 'refresh.lock'), 'w') as lock :
+        try :
+            fcntl.flock(lock, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError :
+            return Current_Version()
+        
+        current = Current_Version()
+        if current is not None :
+            try :
+                # every worker has to be able to map it from disk, not only this one from memory
+                Read_Dataset(os.path.join(STORE_DIR, current))
+            except (OSError, ValueError, KeyError) :
+                logger.warning('Published data %s is missing or unreadable, rebuilding it', current)
+                current = None
+        
+        # another worker may have published while we waited for the lock
+        if current is not None and Data_Age() < REFRESH_INTERVAL :
+            return current
         
-    )
-    
-    # Rolling average line of positive tests
-    fig.add_trace(
-        go.Line(x=new_df['date'],
-                y=new_df['roll_positiveIncrease_7'],
-                marker=dict(color='FireBrick'),
-                line=dict(width=2),
-                name='7-Day Average',
-                legendgroup = 'Cases'
-                ),
-        secondary_y=False
-                
+        snapshot = Load_Snapshot()
+        payload = Fetch_Records(snapshot)
         
-    )
-    
-    # Scatter of d=Infection Rate
-    fig.add_trace(
-        go.Scatter(x=new_df['date'],
-                y=new_df['PosPerTest'],
-                mode='markers',
-                marker=dict(color='Green',size=7),
-                name='Infection Rate',
-                legendgroup = 'Infection'
-                ),
-        secondary_y=True           
-                
+        if payload is UNAVAILABLE :
+            # keep serving what there is, but leave the data stale so the next poll tries again
+            if current is None :
+                current = Publish_Data(Build_Dataset(Clean_Data(snapshot['columns'])))
+                os.utime(os.path.join(STORE_DIR, 'current'), (0, 0))
+            return current
         
-    )
-    
-    # Rolling average of Infection Rate
-    fig.add_trace(
-        go.Line(x=new_df['date'],
-                y=new_df['roll_PosPerTest_7'],
-                marker=dict(color='forestgreen'),
-                line=dict(width=3),
-                name='7-Day Average Infection Rate',
-                legendgroup = 'Infection'
-                ),
-        secondary_y=True
-    )
+        if payload is None and current is None :
+            # cold start with the upstream unchanged, build from the snapshot
+            return Publish_Data(Build_Dataset(Clean_Data(snapshot['columns'])))
+        
+        if payload is None :
+            # nothing new upstream, just mark the published data as fresh again
+            os.utime(os.path.join(STORE_DIR, 'current'))
+            return current
+        
+        data = None
+        if snapshot is None or current is None :
+            data = Build_Dataset(Clean_Data(payload['columns']))
+        else :
+            # the published data was built from the snapshot, so only rows that differ
+            # from it need cleaning
+            changed = Clean_Data(Diff_Records(snapshot['columns'], payload['columns']))
+            try :
+                published = Load_Data(current)
+                if len(changed) :
+                    data = Update_Dataset(published, changed)
+            except Exception :
+                # retrying the same update every poll would never get anywhere, start over
+                # from the full payload instead
+                logger.exception('Incremental update of %s failed, rebuilding from the full payload', current)
+                data = Build_Dataset(Clean_Data(payload['columns']))
+        
+        if data is not None :
+            version = Publish_Data(data)
+        else :
+            os.utime(os.path.join(STORE_DIR, 'current'))
+            version = current
+        
+        # saved only once the data is published, so the two always match
+        Save_Snapshot(payload)
+        
+        return version
+
+
+def Start_Refresher():
+    """Start the daemon thread that keeps the published data fresh"""
     
-    # Setup the layout of legend and title 
-    fig.update_layout(height=700, width=1000,title=dict(text= str(state_of_choice) + ' Tests and Infection Rate',
-                      x=0.5,
-                      font=dict(size=24)),
-                      legend=dict(
-                               yanchor="top",
-                               y=0.99,
-                               xanchor="left",
-                               x=0.01,),
-                      yaxis2_showgrid=False
-                             
-    )
-    # Update Axis labels and range
-    fig.update_yaxes(title_text="Tests", secondary_y=False)
-    fig.update_yaxes(title_text="Infection Rate (%)",secondary_y=True, range=[0,50]) 
-    fig.update_xaxes(title_text="Date")
-    return fig
+    def loop():
+        while True :
+            try :
+                Refresh_Data()
+            except Exception :
+                logger.exception('Data refresh failed')
+            time.sleep(REFRESH_POLL)
+    
+    thread = threading.Thread(target=loop, name='data-refresher', daemon=True)
+    thread.start()
+    
+    return thread
+    
+#%%  Rolling averages precomputed once per refresh
+
+ROLL_METRICS = ['positiveIncrease', 'deathIncrease', 'PosPerTest', 'totalTestResultsIncrease']
+ROLL_WINDOWS = [7, 10, 20]
+
+@Timed('build', rows=lambda data: len(data['df']))
+def Build_Dataset(df):
+    """Bundle the cleaned frame with everything the figures precompute from it"""
+    
+    # keep each state's rows contiguous and in date order so they can be sliced out by position
+    df = df.sort_values(['state', 'date']).reset_index(drop=True)
+    
+    roll = Make_Roll_Cube(df)
+    
+    # population of each state in the order of the cube's state axis
+    data = {'df': df, 'roll': roll,
+            'population': Population(roll['states']), 'hotspots': Make_Hotspots(roll),
+            'aggregates': Make_Aggregates(df)}
+    data['national'] = Make_National_Figures(data)
+    
+    return data
+
+
+@Timed('national_figures')
+def Make_National_Figures(data):
+    """Render the figures every visitor sees the same, as JSON keyed by graph id"""
+    
+    aggregates = data['aggregates']
+    
+    figures = {'Nat': Make_National(aggregates),
+               'Nat_Test_Plot': Make_National_Test_Plot(aggregates),
+               'Top_10': Make_Top_Ten(data),
+               'R_B': Make_R_B_National(aggregates),
+               'R_B_Sum': Make_R_B_Sum(aggregates)}
+    
+    return {name: Figure_JSON(fig) for name, fig in figures.items()}
+
+
+def National_Figure(data, name):
+    """The prerendered national figure for graph id name"""
+    
+    return json.loads(data['national'][name])
+
+
+def National_Extension(data, shown, name):
+    """extendData taking graph id name from the national figure of version shown to the one
+    of data, or None when the figure has to be sent whole"""
+    
+    # shown comes from the page, only versions in the store get a cache entry
+    if not isinstance(shown, str) :
+        return None
+    try :
+        old = Load_Data(shown)
+    except KeyError :
+        # pruned from the store, or not a version at all
+        return None
+    
+    def build():
+        text = json.dumps(Figure_Extension(National_Figure(old, name), National_Figure(data, name)),
+                          separators=(',', ':'))
+        Observe_Size('extension', len(text))
+        return text
+    
+    key = ('National_Extension', data['version'], shown, name)
+    
+    return json.loads(FIGURE_CACHE.get(key, build))
+
+
+def Figure_Extension(old, new):
+    """The points new appends to the traces of old, as extendData. None unless new is old with
+    only points added at the end of its traces, a revised point or any other change anywhere
+    in the figure means it has to be sent whole."""
+    
+    if old['layout'] != new['layout'] or len(old['data']) != len(new['data']) :
+        return None
+    
+    tails = {}
+    for a, b in zip(old['data'], new['data']) :
+        arrays = [axis for axis in ('x', 'y') if axis in b]
+        if arrays != [axis for axis in ('x', 'y') if axis in a] :
+            return None
+        if {k: v for k, v in a.items() if k not in arrays} != {k: v for k, v in b.items() if k not in arrays} :
+            return None
+        
+        for axis in arrays :
+            before, after = Trace_Values(a[axis]), Trace_Values(b[axis])
+            if after[:len(before)] != before :
+                return None
+            tails.setdefault(axis, []).append(after[len(before):])
+    
+    # extendData takes the same arrays for every trace it extends
+    if any(len(tail) != len(new['data']) for tail in tails.values()) :
+        return None
+    
+    return [tails, list(range(len(new['data'])))]
+
+
+def Trace_Values(values):
+    """A trace array as written by Array, back as a list with the gaps as None"""
+    
+    if isinstance(values, dict) :
+        values = np.frombuffer(base64.b64decode(values['bdata']), dtype='<' + values['dtype'])
+        return [None if v != v else v for v in values.tolist()]
+    
+    return values
+
+
+@Timed('update', rows=lambda data: len(data['df']))
+def Update_Dataset(data, changed):
+    """The dataset with the cleaned rows of changed added, or replacing the rows of the same
+    state and date. Only the days from the earliest changed one on are recomputed."""
+    
+    old = data['df']
+    since = changed['date'].min()
+    
+    # drop the replaced rows and put the new ones in their (state, date) place
+    replaced = pd.MultiIndex.from_frame(old[['state', 'date']].astype({'state': object})).isin(
+               pd.MultiIndex.from_frame(changed[['state', 'date']]))
+    kept = old[~replaced]
+    states = kept['state'].cat.categories.union(changed['state'].cat.categories)
+    df = pd.concat([kept.assign(state=kept['state'].cat.set_categories(states)),
+                    changed.assign(state=changed['state'].cat.set_categories(states))],
+                   ignore_index=True)
+    df = df.sort_values(['state', 'date']).reset_index(drop=True)
+    
+    # day over day increases from each state's first changed day on, the day before
+    # it is only there as the base of the first difference
+    # mapped on plain values, a categorical maps to a categorical when the mapping is one to one
+    first = pd.to_datetime(df['state'].astype(object).map(changed.groupby('state')['date'].min()))
+    window = df[first.notna() & (df['date'] >= first - pd.Timedelta(days=1))]
+    increases = Daily_Increase(window)
+    redo = window.index[window['date'] >= first[window.index]]
+    df.loc[redo, list(INCREASES)] = increases.loc[redo, list(INCREASES)]
+    
+    roll = Update_Roll_Cube(data['roll'], df, since)
+    
+    hotspots = data['hotspots']
+    if since > hotspots['date'] and np.array_equal(roll['states'], data['roll']['states']) :
+        # only new days, move the hotspot window on one day at a time
+        m = roll['metrics']
+        for day in roll['dates'][roll['dates'] > hotspots['date']] :
+            i = (day - roll['dates'][0]).days
+            hotspots = Update_Hotspots(hotspots, day,
+                                       roll['values'][:, i, m.index('positiveIncrease')],
+                                       roll['values'][:, i, m.index('totalTestResultsIncrease')])
+    else :
+        hotspots = Make_Hotspots(roll)
+    
+    data = {'df': df, 'roll': roll,
+            'population': Population(roll['states']), 'hotspots': hotspots,
+            'aggregates': Make_Aggregates(df)}
+    data['national'] = Make_National_Figures(data)
+    
+    return data
+
+
+def Make_Roll_Cube(df, metrics=ROLL_METRICS, windows=ROLL_WINDOWS):
+    """Lay the metrics out on a dense state x date grid and take the trailing mean over every
+    window. 'values' has shape (state, date, metric) and 'means' (state, date, metric, window)."""
+    
+    states = np.sort(df['state'].unique())
+    dates = pd.date_range(df['date'].min(), df['date'].max(), freq='D')
+    
+    s = states.searchsorted(df['state'].to_numpy())
+    d = (df['date'] - dates[0]).dt.days.to_numpy()
+    
+    values = np.full((len(states), len(dates), len(metrics)), np.nan)
+    values[s, d] = df[metrics].to_numpy(dtype=float)
+    
+    reported = np.zeros((len(states), len(dates)), dtype=bool)
+    reported[s, d] = True
+    
+    # every (state, metric) pair is one column of a date x column block for Roll_Means
+    block = values.transpose(1, 0, 2).reshape(len(dates), -1)
+    means = Roll_Means(block, windows, shift=False)
+    means = means.reshape(len(dates), len(states), len(metrics), len(windows)).transpose(1, 0, 2, 3)
+    
+    return {'states': states,
+            'dates': dates,
+            'metrics': list(metrics),
+            'windows': list(windows),
+            'values': values,
+            'means': np.ascontiguousarray(means),
+            'first': reported.argmax(axis=1),
+            'last': len(dates) - 1 - reported[:, ::-1].argmax(axis=1)}
+
+
+def Update_Roll_Cube(roll, df, since):
+    """roll brought up to date with df, when only rows of df dated since or later changed.
+    Days before since are copied and the means recomputed from since on, using the
+    longest window's worth of earlier days."""
+    
+    metrics, windows = roll['metrics'], roll['windows']
+    states = roll['states']
+    
+    if since <= roll['dates'][0] or not np.array_equal(np.sort(df['state'].unique()), states) :
+        return Make_Roll_Cube(df, metrics, windows)
+    
+    dates = pd.date_range(roll['dates'][0], df['date'].max(), freq='D')
+    i = (since - dates[0]).days
+    
+    rows = df[df['date'] >= since]
+    s = states.searchsorted(rows['state'].to_numpy())
+    d = (rows['date'] - dates[0]).dt.days.to_numpy()
+    
+    values = np.full((len(states), len(dates), len(metrics)), np.nan)
+    values[:, :i] = roll['values'][:, :i]
+    values[s, d] = rows[metrics].to_numpy(dtype=float)
+    
+    lo = max(0, i - max(windows) + 1)
+    block = values[:, lo:].transpose(1, 0, 2).reshape(len(dates) - lo, -1)
+    tail = Roll_Means(block, windows, shift=False)
+    tail = tail.reshape(len(dates) - lo, len(states), len(metrics), len(windows)).transpose(1, 0, 2, 3)
+    
+    means = np.full(values.shape + (len(windows),), np.nan)
+    means[:, :i] = roll['means'][:, :i]
+    means[:, i:] = tail[:, i - lo:]
+    
+    # rows are only ever added or replaced, so reports can only start earlier or end later
+    first, last = np.array(roll['first']), np.array(roll['last'])
+    np.minimum.at(first, s, d)
+    np.maximum.at(last, s, d)
+    
+    return {'states': states,
+            'dates': dates,
+            'metrics': list(metrics),
+            'windows': list(windows),
+            'values': values,
+            'means': means,
+            'first': first,
+            'last': last}
+
+
+def State_Dates(roll, state):
+    """Dates from a state's first to last report"""
+    
+    i = Roll_State(roll, state)
+    
+    return roll['dates'][roll['first'][i]:roll['last'][i] + 1]
+
+
+def State_Series(roll, state, metric, window=None, lag=0):
+    """Daily values of metric for state (window=None) or their trailing window-day mean,
+    over the same dates as State_Dates. With lag=1 each day gets the mean of the window
+    days before it, which is what Roll_Avg's shift mode gives on newest-first rows."""
+    
+    i = Roll_State(roll, state)
+    m = roll['metrics'].index(metric)
+    
+    if window is None :
+        series = roll['values'][i, :, m]
+    else :
+        series = roll['means'][i, :, m, roll['windows'].index(window)]
+    
+    if lag :
+        series = np.concatenate([np.full(lag, np.nan), series[:-lag]])
+    
+    return series[roll['first'][i]:roll['last'][i] + 1]
+
+
+def Roll_State(roll, state):
+    """Position of state on the cube's state axis"""
+    
+    i = roll['states'].searchsorted(state)
+    if i == len(roll['states']) or roll['states'][i] != state :
+        raise KeyError('No data for state: ' + str(state))
+    
+    return i
+
+#%%  Daily national and partisan aggregates, one grouping of the rows per refresh
+
+AGGREGATE_METRICS = ['positiveIncrease', 'deathIncrease', 'totalTestResultsIncrease']
+
+# running totals and the daily column each one is the sum of
+AGGREGATE_TOTALS = {'positiveTotal': 'positiveIncrease', 'deathTotal': 'deathIncrease'}
+
+def Make_Aggregates(df):
+    """Date indexed table of the sums the national figures plot. The columns are (metric, group)
+    with group 'National' or one of the '2016 Won By' labels."""
+    
+    return Aggregate_Totals(Aggregate_Sums(df))
+
+
+def Aggregate_Sums(df):
+    """Sum the metrics, and the increases per 1M people, for each date and '2016 Won By'
+    group in a single groupby. The national sums add up the two groups."""
+    
+    state = df['state'].cat
+    per_million = Population(state.categories)[state.codes.to_numpy()]/1000000
+    
+    sums = df[['date', '2016 Won By'] + AGGREGATE_METRICS].assign(
+                positiveIncreasescale=df['positiveIncrease']/per_million,
+                deathIncreasescale=df['deathIncrease']/per_million,
+                ).groupby(['date', '2016 Won By']).sum()
+    
+    national = sums[AGGREGATE_METRICS].groupby(level='date').sum()
+    national['PosPerTest'] = national['positiveIncrease']/national['totalTestResultsIncrease']*100
+    national.columns = pd.MultiIndex.from_product([national.columns, ['National']])
+    
+    groups = sums.unstack()
+    groups.columns = pd.MultiIndex.from_tuples([(metric, str(group)) for metric, group in groups.columns])
+    
+    return pd.concat([national, groups], axis=1)
+
+
+def Aggregate_Totals(sums):
+    """Add the running totals of AGGREGATE_TOTALS to a table from Aggregate_Sums"""
+    
+    totals = sums[list(AGGREGATE_TOTALS.values())].cumsum()
+    totals = totals.rename(columns={metric: total for total, metric in AGGREGATE_TOTALS.items()}, level=0)
+    
+    return pd.concat([sums, totals], axis=1)
+
+#%%  Per capita hotspots, ranked from the last few days only
+
+HOTSPOT_WINDOW = 10
+
+def Make_Hotspots(roll, window=HOTSPOT_WINDOW):
+    """Keep the last window days of daily cases and tests of every state, in the order of
+    the cube's state axis. That is all Make_Top_Ten needs, however long the history."""
+    
+    def last_days(metric):
+        days = roll['values'][:, -window:, roll['metrics'].index(metric)]
+        days = np.where(np.isfinite(days), days, np.nan)
+        # states of a history shorter than the window get missing days in front
+        return np.concatenate([np.full((len(days), window - days.shape[1]), np.nan), days], axis=1)
+    
+    return {'date': roll['dates'][-1],
+            'cases': last_days('positiveIncrease'),
+            'tests': last_days('totalTestResultsIncrease')}
+
+
+def Update_Hotspots(hotspots, date, cases, tests):
+    """Hotspots moved on to date, given that day's cases and tests of every state
+    (NaN where a state did not report). Days skipped in between count as missing."""
+    
+    date = pd.Timestamp(date)
+    steps = (date - hotspots['date']).days
+    if steps <= 0 :
+        raise ValueError('Hotspots are already at ' + str(hotspots['date'].date()))
+    
+    def push(days, today):
+        today = np.where(np.isfinite(today), today, np.nan)
+        gap = np.full((len(days), steps - 1), np.nan)
+        return np.concatenate([days, gap, np.asarray(today, dtype=float)[:, None]], axis=1)[:, -days.shape[1]:]
+    
+    return {'date': date,
+            'cases': push(hotspots['cases'], cases),
+            'tests': push(hotspots['tests'], tests)}
+
+
+def Rank_Hotspots(values, k=10):
+    """Positions of the k largest values, largest first. NaN is never ranked."""
+    
+    values = np.where(np.isnan(values), -np.inf, values)
+    k = min(k, int(np.isfinite(values).sum()))
+    if k == 0 :
+        return np.array([], dtype=int)
+    
+    # argpartition finds the top k in linear time, only those k get sorted
+    top = np.argpartition(-values, k - 1)[:k]
+    
+    return top[np.argsort(-values[top], kind='stable')]
 
 #%%
 
+def Roll_Avg(df, col, interval,shift = True, groups = None) :
+    """Calculate the rolling averages of interval duration of columns in df.
+    col may be one column or a list of them, see Roll_Means for shift and groups."""
+    
+    cols = list(col) if isinstance(col, (list, tuple)) else [col]
+    means = Roll_Means(df[cols].to_numpy(dtype=float), interval, shift, groups)
+    
+    # make new cols called roll_col_interval, in the order Roll_Means returns them
+    names = ['roll_' + str(c) + '_' + str(n) for c in cols for n in interval]
+    for k, name in enumerate(names) :
+        df[name] = means[:, k]
+
+
+def Roll_Means(values, windows, shift = False, groups = None) :
+    """Rolling means of every column of values over every window, from a single prefix sum.
+    
+    values is a 1-D array or a rows x columns array. The result has one column per
+    (column, window) pair, windows varying fastest. A trailing window ends on its row,
+    with shift=True it is the window rows after the row instead, which is the same as
+    rolling(n).mean().shift(-n). groups labels the rows of contiguous groups, windows
+    never reach across a group boundary. A window with a missing or infinite value is
+    NaN, as with pandas rolling."""
+    
+    values = np.asarray(values, dtype=float)
+    if values.ndim == 1 :
+        values = values[:, None]
+    rows, cols = values.shape
+    
+    # prefix sums with a leading zero row, sums[j] - sums[i] is the total of rows i..j-1
+    finite = np.isfinite(values)
+    sums = np.zeros((rows + 1, cols))
+    np.cumsum(np.where(finite, values, 0), axis=0, out=sums[1:])
+    missing = np.zeros((rows + 1, cols), dtype=np.int64)
+    np.cumsum(~finite, axis=0, out=missing[1:])
+    
+    # first and one past last row of the group each row belongs to
+    if groups is None :
+        starts, stops = 0, rows
+    else :
+        groups = np.asarray(groups)
+        bounds = np.concatenate([[0], np.flatnonzero(groups[1:] != groups[:-1]) + 1, [rows]])
+        sizes = np.diff(bounds)
+        starts, stops = np.repeat(bounds[:-1], sizes), np.repeat(bounds[1:], sizes)
+    
+    row = np.arange(rows)
+    means = np.full((rows, cols, len(windows)), np.nan)
+    for k, n in enumerate(windows) :
+        lo = row + 1 if shift else row - n + 1
+        hi = lo + n
+        full = (lo >= starts) & (hi <= stops)
+        lo, hi = lo[full], hi[full]
+        gaps = missing[hi] - missing[lo]
+        means[full, :, k] = np.where(gaps == 0, (sums[hi] - sums[lo]) / n, np.nan)
+    
+    return means.reshape(rows, cols * len(windows))
+            
+#%%  Figures as plain dicts, built from fixed layouts with only the data filled in
+
+# the layouts below are what make_subplots and update_layout produced for these figures,
+# written out once so a figure is a few dict literals rather than validated graph objects
+FIGURE_TEMPLATE = pio.templates[pio.templates.default].to_plotly_json()
+
+LEGEND = {'yanchor': 'top', 'y': 0.99, 'xanchor': 'left', 'x': 0.01}
+
+DAY_MS = 86400000 # dx of a daily date axis, plotly measures dates in ms
+
+
+def Figure_Title(text):
+    
+    return {'text': text, 'font': {'size': 24}, 'x': 0.5}
+
+
+def Subplot_Title(text, x):
+    
+    return {'text': text, 'font': {'size': 16}, 'showarrow': False,
+            'x': x, 'xanchor': 'center', 'xref': 'paper',
+            'y': 1.0, 'yanchor': 'bottom', 'yref': 'paper'}
+
+
+def Two_Panel_Figure(subplot_titles, x_titles, y_titles=(None, None)):
+    """Figure dict laid out like make_subplots(rows=1, cols=2), one title per panel and axis"""
+    
+    layout = {'template': FIGURE_TEMPLATE,
+              'xaxis': {'anchor': 'y', 'domain': [0.0, 0.45]},
+              'yaxis': {'anchor': 'x', 'domain': [0.0, 1.0]},
+              'xaxis2': {'anchor': 'y2', 'domain': [0.55, 1.0]},
+              'yaxis2': {'anchor': 'x2', 'domain': [0.0, 1.0]},
+              'annotations': [Subplot_Title(text, x) for text, x in zip(subplot_titles, [0.225, 0.775])]}
+    
+    for suffix, x_title, y_title in zip(['', '2'], x_titles, y_titles) :
+        layout['xaxis' + suffix]['title'] = {'text': x_title}
+        if y_title is not None :
+            layout['yaxis' + suffix]['title'] = {'text': y_title}
+    
+    return {'data': [], 'layout': layout}
+
+
+def Secondary_Y_Figure(x_title, y_title, y2_title, y2_range):
+    """Figure dict laid out like make_subplots(specs=[[{"secondary_y": True}]])"""
+    
+    return {'data': [],
+            'layout': {'template': FIGURE_TEMPLATE,
+                       'xaxis': {'anchor': 'y', 'domain': [0.0, 0.94], 'title': {'text': x_title}},
+                       'yaxis': {'anchor': 'x', 'domain': [0.0, 1.0], 'title': {'text': y_title}},
+                       'yaxis2': {'anchor': 'x', 'overlaying': 'y', 'side': 'right', 'showgrid': False,
+                                  'title': {'text': y2_title}, 'range': y2_range}}}
+
 
-def Make_State(df,state_of_choice):
+def Trace(type, x, y, col=1, secondary_y=False, **props):
+    """Trace dict on the axes of panel col, or on the secondary y axis. x is either the values
+    or a Date_Axis shared by the traces of the figure."""
+    
+    suffix = '' if col == 1 else str(col)
     
+    trace = dict(type=type, xaxis='x' + suffix, yaxis='y2' if secondary_y else 'y' + suffix, **props)
+    trace.update(x if isinstance(x, dict) else {'x': Array(x)})
+    trace['y'] = Array(y)
     
-    new_df = State_Subset(df,state_of_choice)
-    interval = [7,20]#sets the intervals for the rolling averages
-    state_cases = new_df.groupby('date')['positiveIncrease'].sum().reset_index()
-    state_deaths = new_df.groupby('date')['deathIncrease'].sum().reset_index()
+    return trace
+
 
-    state_cases['date'] = state_cases.date.dt.strftime('%Y-%m-%d')
-    Roll_Avg(state_cases, 'positiveIncrease', interval,shift=False)
+def Date_Axis(dates):
+    """x of traces over dates. A run of consecutive days is only its first day and a one day
+    step, so no date array is sent, anything else falls back to the dates as strings."""
     
-    state_deaths['date'] = state_deaths.date.dt.strftime('%Y-%m-%d')
-    Roll_Avg(state_deaths, 'deathIncrease', interval,shift=False)
+    days = np.asarray(dates, dtype='datetime64[D]')
     
-    # print(national_cases['date'], national_cases['positiveIncrease'])
+    if len(days) and (np.diff(days) == np.timedelta64(1, 'D')).all() :
+        return {'x0': str(days[0]), 'dx': DAY_MS}
+    
+    return {'x': np.datetime_as_string(days).tolist()}
+
+
+def Array(values):
+    """Trace data as a typed array when the client decodes them, otherwise a list with NaN as null"""
     
-    fig = make_subplots(rows=1, cols=2,
-                        subplot_titles = [str(state_of_choice)+ ' Cases per Day'
-                                          , str(state_of_choice)+ ' Deaths per Day'],
-                        )
+    values = np.asarray(values)
+    kind = values.dtype.kind
     
-    fig.add_trace(
-        go.Bar(x=state_cases['date'],
-                y=state_cases['positiveIncrease'],
-                marker=dict(color=color['Bar']),
-                legendgroup='Bars',
-                name= str(state_of_choice) + ' Daily Increase'
-                ),row=1,col=1
-    )
+    if kind not in 'iuf' :
+        return values.tolist()
     
+    # a rate over a day without tests is inf, it is a gap in the line like NaN
+    missing = ~np.isfinite(values) if kind == 'f' else None
+    
+    if BINARY_ARRAYS :
+        # plotly.js has no 64 bit ints, counts that fit go as int32 and the rest as float64
+        fits = kind != 'f' and (not len(values) or (values.min() >= -2**31 and values.max() < 2**31))
+        dtype = 'i4' if fits else 'f8'
+        values = values.astype('<' + dtype)
+        if missing is not None :
+            values[missing] = np.nan
+        return {'dtype': dtype, 'bdata': base64.b64encode(values.tobytes()).decode('ascii')}
+    
+    if missing is not None and missing.any() :
+        values = values.astype(object)
+        values[missing] = None
+    
+    return values.tolist()
+
+
+def Plotly_JS_Version():
+    """Version of the plotly.js bundled with dcc.Graph, read from the banner of the bundle"""
     
-    fig.add_trace(
-        go.Line(x=state_cases['date'],
-                y=state_cases['roll_positiveIncrease_7'],
-                marker=dict(color=color['7-day']),
-                line=dict(width=4),
-                legendgroup='7Day',
-                name='7-Day Average'
-                ),row=1,col=1
+    try :
+        with open(os.path.join(os.path.dirname(dash.dcc.__file__), 'plotly.min.js')) as f :
+            return tuple(int(v) for v in re.search(r'plotly\.js v(\d+)\.(\d+)', f.read(200)).groups())
+    except (OSError, AttributeError) :
+        return (0, 0)
+
+
+# plotly.js decodes {'dtype', 'bdata'} arrays from 2.28 on, older bundles get plain lists
+BINARY_ARRAYS = os.environ.get('COVID_BINARY_ARRAYS', str(int(Plotly_JS_Version() >= (2, 28)))) == '1'
+
+# the national figures are prerendered into the stored data, so whatever changes how they
+# render, the figure code in this module, plotly's template or the array encoding, has to
+# change the version token too
+with open(__file__, 'rb') as f :
+    RENDER_VERSION = hashlib.md5(f.read() + json.dumps(FIGURE_TEMPLATE, sort_keys=True).encode()
+                                 + str(BINARY_ARRAYS).encode()).hexdigest()
+
+
+@Timed('figure_json')
+def Figure_JSON(fig):
+    """Serialize a figure dict. Its arrays are already plain lists or typed arrays, so this is a
+    single json.dumps rather than plotly's encoder and its second pass over the output."""
+    
+    text = json.dumps(fig, separators=(',', ':'))
+    Observe_Size('figure', len(text))
+    
+    return text
+
+
+#%%
+
+@Timed('figure.Make_Test_Plot')
+def Make_Test_Plot(data,state_of_choice) :
+    
+    roll = data['roll']
+    
+    ## Slice the state of interest out of the precomputed rolling averages, the 7 day
+    ## averages are of the days before each date
+    dates = Date_Axis(State_Dates(roll, state_of_choice))
+    tests = State_Series(roll, state_of_choice, 'totalTestResultsIncrease')
+    cases = State_Series(roll, state_of_choice, 'positiveIncrease')
+    rate = State_Series(roll, state_of_choice, 'PosPerTest')
+    tests_7 = State_Series(roll, state_of_choice, 'totalTestResultsIncrease', 7, lag=1)
+    cases_7 = State_Series(roll, state_of_choice, 'positiveIncrease', 7, lag=1)
+    rate_7 = State_Series(roll, state_of_choice, 'PosPerTest', 7, lag=1)
+    
+    # secondary y scale for infection rate
+    fig = Secondary_Y_Figure('Date', 'Tests', 'Infection Rate (%)', [0,50])
+    
+    fig['data'] += [
+        # Add barplot of total tests per day
+        Trace('bar', dates, tests,
+              marker=dict(color=color['Bar']),
+              name='Total Tests',
+              legendgroup = 'Tests',
+              offsetgroup='0'
+              ),
+        
+        # Add barplotof positive tests per day
+        Trace('bar', dates, cases,
+              marker=dict(color=color['Bar2']),
+              name='Positive Tests',
+              offsetgroup='0',
+              legendgroup = 'Cases'
+              ),
         
-    )
-    
-    fig.add_trace(
-        go.Line(x=state_cases['date'],
-                y=state_cases['roll_positiveIncrease_20'],
-                marker=dict(color=color['20-day']),
-                line=dict(width=2),
-                legendgroup='20Day',
-                name='20-Day Average'
-                ),row=1,col=1
+        #Rolling average trace of testing 
+        Trace('scatter', dates, tests_7,
+              marker=dict(color='Black'),
+              line=dict(width=2),
+              name='7-Day Average',
+              legendgroup = 'Tests'
+              ),
         
-    )
-    
-    
-    fig.update_yaxes(title_text="New Deaths")
- 
-    fig.update_xaxes(title_text="Date")
-    
-    fig.add_trace(
-        go.Bar(x=state_deaths['date'],
-                y=state_deaths['deathIncrease'],
-                marker=dict(color=color['Bar']),
-                legendgroup='Bars',
-                showlegend=False,
-                name= str(state_of_choice)+' Daily Deaths Increase'
-                ),row=1,col=2
-    )
-    
-    
-    fig.add_trace(
-        go.Line(x=state_deaths['date'],
-                y=state_deaths['roll_deathIncrease_7'],
-                marker=dict(color=color['7-day']),
-                line=dict(width=2),
-                legendgroup='7Day',
-                showlegend=False,
-                name='7-Day Average'
-                ),row=1,col=2
+        # Rolling average line of positive tests
+        Trace('scatter', dates, cases_7,
+              marker=dict(color='FireBrick'),
+              line=dict(width=2),
+              name='7-Day Average',
+              legendgroup = 'Cases'
+              ),
         
-    )
-    fig.add_trace(
-        go.Line(x=state_deaths['date'],
-                y=state_deaths['roll_deathIncrease_20'],
-                marker=dict(color=color['20-day']),
-                line=dict(width=2),
-                legendgroup='20Day',
-                showlegend=False,
-                name='20-Day Average'
-                ),row=1,col=2
+        # Scatter of d=Infection Rate
+        Trace('scatter', dates, rate, secondary_y=True,
+              mode='markers',
+              marker=dict(color='Green',size=7),
+              name='Infection Rate',
+              legendgroup = 'Infection'
+              ),
         
-    )
-    
-
-    fig.update_layout(
-                title=dict(text= str(state_of_choice) + " Cases and Deaths",
-                font=dict(size=24),
-                x = 0.5),
-                xaxis_title='Date',
-                yaxis_title='New Cases',                
-                legend=dict(
-                               yanchor="top",
-                               y=0.99,
-                               xanchor="left",
-                               x=0.01,),
-                    )         
+        # Rolling average of Infection Rate
+        Trace('scatter', dates, rate_7, secondary_y=True,
+              marker=dict(color='forestgreen'),
+              line=dict(width=3),
+              name='7-Day Average Infection Rate',
+              legendgroup = 'Infection'
+              ),
+        ]
     
+    # Setup the layout of legend and title 
+    fig['layout'].update(height=700, width=1000,
+                         title=Figure_Title(str(state_of_choice) + ' Tests and Infection Rate'),
+                         legend=LEGEND)
     return fig
-    
 
 #%%
 
-def Make_National(df) :
 
-    national_cases = df.groupby('date')['positiveIncrease'].sum().reset_index()
+@Timed('figure.Make_State')
+def Make_State(data,state_of_choice):
     
-    national_cases['date'] = national_cases.date.dt.strftime('%Y-%m-%d')
-    Roll_Avg(national_cases, 'positiveIncrease', [7,20],shift=False)
+    roll = data['roll']
+    
+    # slice the state out of the precomputed 7 and 20 day averages
+    dates = Date_Axis(State_Dates(roll, state_of_choice))
+    cases = State_Series(roll, state_of_choice, 'positiveIncrease')
+    cases_7 = State_Series(roll, state_of_choice, 'positiveIncrease', 7)
+    cases_20 = State_Series(roll, state_of_choice, 'positiveIncrease', 20)
+    deaths = State_Series(roll, state_of_choice, 'deathIncrease')
+    deaths_7 = State_Series(roll, state_of_choice, 'deathIncrease', 7)
+    deaths_20 = State_Series(roll, state_of_choice, 'deathIncrease', 20)
     
-    # print(national_cases['date'], national_cases['positiveIncrease'])
-    fig = make_subplots(rows=1, cols=2,
-                    subplot_titles = ['National Cases per Day'
-                                          , 'National Deaths per Day'],
-                        )
-    
-    fig.add_trace(
-        go.Bar(x=national_cases['date'],
-                y=national_cases['positiveIncrease'],
-                marker=dict(color=color['Bar']),
-                legendgroup = 'Bar',
-                name='National Daily Case Increase'
-                ),row=1,col=1
-    )
-    
-    
-    fig.add_trace(
-        go.Line(x=national_cases['date'],
-                y=national_cases['roll_positiveIncrease_7'],
-                marker=dict(color=color['7-day']),
-                line=dict(width=4),
-                legendgroup = '7Avg',
-                name='7-Day Average'
-                ),row=1,col=1
+    fig = Two_Panel_Figure([str(state_of_choice)+ ' Cases per Day'
+                            , str(state_of_choice)+ ' Deaths per Day'],
+                           ['Date', 'Date'], ['New Cases', 'New Deaths'])
+    
+    fig['data'] += [
+        Trace('bar', dates, cases,
+              marker=dict(color=color['Bar']),
+              legendgroup='Bars',
+              name= str(state_of_choice) + ' Daily Increase'
+              ),
+        
+        Trace('scatter', dates, cases_7,
+              marker=dict(color=color['7-day']),
+              line=dict(width=4),
+              legendgroup='7Day',
+              name='7-Day Average'
+              ),
+        
+        Trace('scatter', dates, cases_20,
+              marker=dict(color=color['20-day']),
+              line=dict(width=2),
+              legendgroup='20Day',
+              name='20-Day Average'
+              ),
         
-    )
-
-    fig.add_trace(
-        go.Line(x=national_cases['date'],
-                y=national_cases['roll_positiveIncrease_20'],
-                marker=dict(color=color['20-day']),
-                line=dict(width=2),
-                legendgroup = '20Avg',
-                name='20-Day Average'
-                ),row=1,col=1
+        Trace('bar', dates, deaths, col=2,
+              marker=dict(color=color['Bar']),
+              legendgroup='Bars',
+              showlegend=False,
+              name= str(state_of_choice)+' Daily Deaths Increase'
+              ),
         
-    )
+        Trace('scatter', dates, deaths_7, col=2,
+              marker=dict(color=color['7-day']),
+              line=dict(width=2),
+              legendgroup='7Day',
+              showlegend=False,
+              name='7-Day Average'
+              ),
+        
+        Trace('scatter', dates, deaths_20, col=2,
+              marker=dict(color=color['20-day']),
+              line=dict(width=2),
+              legendgroup='20Day',
+              showlegend=False,
+              name='20-Day Average'
+              ),
+        ]
+
+    fig['layout'].update(title=Figure_Title(str(state_of_choice) + " Cases and Deaths"),
+                         legend=LEGEND)
+    
+    return fig
+    
+
+#%%  Per-state series for drawing the state figures in the browser
 
-    fig.update_yaxes(title_text="New Deaths")
- 
-    fig.update_xaxes(title_text="Date")
+# with COVID_CLIENTSIDE_STATES=1 the page gets every state's series once per data version and
+# assets/state_figures.js draws the state figures, so switching states never reaches the server
+CLIENTSIDE_STATES = os.environ.get('COVID_CLIENTSIDE_STATES', '0') == '1'
 
+# what Make_State and Make_Test_Plot plot of a state, as (metric, window) with None for the
+# daily values. The 7 day averages lagged by a day in Make_Test_Plot are shifted in the browser.
+STATE_BUNDLE_SERIES = [('positiveIncrease', None), ('positiveIncrease', 7), ('positiveIncrease', 20),
+                       ('deathIncrease', None), ('deathIncrease', 7), ('deathIncrease', 20),
+                       ('totalTestResultsIncrease', None), ('totalTestResultsIncrease', 7),
+                       ('PosPerTest', None), ('PosPerTest', 7)]
 
-    national_deaths = df.groupby('date')['deathIncrease'].sum().reset_index()
+def Make_State_Bundle(data):
+    """Every state's series over the dates of the roll cube, each a state x date block of
+    float32 as base64, with the first and last day each state reported"""
     
-    national_deaths['date'] = national_deaths.date.dt.strftime('%Y-%m-%d')
-    Roll_Avg(national_deaths, 'deathIncrease', [7,20],shift=False)
+    roll = data['roll']
+    m = roll['metrics']
+    
+    series = {}
+    for metric, window in STATE_BUNDLE_SERIES :
+        if window is None :
+            name, values = metric, roll['values'][:, :, m.index(metric)]
+        else :
+            name, values = metric + '_' + str(window), roll['means'][:, :, m.index(metric), roll['windows'].index(window)]
+        series[name] = base64.b64encode(np.ascontiguousarray(values, dtype='<f4').tobytes()).decode('ascii')
+    
+    return {'version': data['version'],
+            'start': str(roll['dates'][0].date()),
+            'days': len(roll['dates']),
+            'states': [str(state) for state in roll['states']],
+            'first': roll['first'].tolist(),
+            'last': roll['last'].tolist(),
+            'series': series,
+            'template': FIGURE_TEMPLATE}
+
+
+def State_Bundle(data):
+    """Make_State_Bundle(data), built once per data version"""
+    
+    key = ('Make_State_Bundle', data['version'])
     
+    return json.loads(FIGURE_CACHE.get(key, lambda: json.dumps(Make_State_Bundle(data), separators=(',', ':'))))
 
+#%%
+
+@Timed('figure.Make_National')
+def Make_National(aggregates) :
+
+    national = aggregates.xs('National', axis=1, level=1)
+    dates = Date_Axis(aggregates.index)
+    national_cases = national[['positiveIncrease']].reset_index()
+
+    Roll_Avg(national_cases, 'positiveIncrease', [7,20],shift=False)
+
+    national_deaths = national[['deathIncrease']].reset_index()
+
+    Roll_Avg(national_deaths, 'deathIncrease', [7,20],shift=False)
+    
+    fig = Two_Panel_Figure(['National Cases per Day'
+                            , 'National Deaths per Day'],
+                           ['Date', 'Date'], ['New Cases', 'New Deaths'])
     
-    fig.add_trace(
-        go.Bar(x=national_deaths['date'],
-                y=national_deaths['deathIncrease'],
-                marker=dict(color=color['Bar']),
-                legendgroup = 'Bar',
-                showlegend=False,
-                
-                name='National Daily Case Increase'
-                ),row=1, col=2
-    )
-    
-    
-    fig.add_trace(
-        go.Line(x=national_deaths['date'],
-                y=national_deaths['roll_deathIncrease_7'],
-                marker=dict(color= color['7-day']),
-                showlegend=False,
-                legendgroup = '7Avg',
-                line=dict(width=4),
-                name='7-Day Average'
-                ),row=1, col=2
+    fig['data'] += [
+        Trace('bar', dates, national_cases['positiveIncrease'],
+              marker=dict(color=color['Bar']),
+              legendgroup = 'Bar',
+              name='National Daily Case Increase'
+              ),
+        
+        Trace('scatter', dates, national_cases['roll_positiveIncrease_7'],
+              marker=dict(color=color['7-day']),
+              line=dict(width=4),
+              legendgroup = '7Avg',
+              name='7-Day Average'
+              ),
+        
+        Trace('scatter', dates, national_cases['roll_positiveIncrease_20'],
+              marker=dict(color=color['20-day']),
+              line=dict(width=2),
+              legendgroup = '20Avg',
+              name='20-Day Average'
+              ),
         
-    )
-
-    fig.add_trace(
-        go.Line(x=national_deaths['date'],
-                y=national_deaths['roll_deathIncrease_20'],
-                marker=dict(color= color['20-day']),
-                showlegend=False,
-                legendgroup = '20Avg',
-                line=dict(width=2),
-                name='20-Day Average'
-                ),row=1, col=2
+        Trace('bar', dates, national_deaths['deathIncrease'], col=2,
+              marker=dict(color=color['Bar']),
+              legendgroup = 'Bar',
+              showlegend=False,
+              name='National Daily Case Increase'
+              ),
         
-    )
+        Trace('scatter', dates, national_deaths['roll_deathIncrease_7'], col=2,
+              marker=dict(color= color['7-day']),
+              showlegend=False,
+              legendgroup = '7Avg',
+              line=dict(width=4),
+              name='7-Day Average'
+              ),
         
-    fig.update_layout(
-                title= dict(text ="National Cases & Deaths",
-                font=dict(size=24),
-                x = 0.5),
-                xaxis_title='Date',
-                yaxis_title='New Cases',                
-                legend=dict(
-                               yanchor="top",
-                               y=0.99,
-                               xanchor="left",
-                               x=0.01,),
-                    )
+        Trace('scatter', dates, national_deaths['roll_deathIncrease_20'], col=2,
+              marker=dict(color= color['20-day']),
+              showlegend=False,
+              legendgroup = '20Avg',
+              line=dict(width=2),
+              name='20-Day Average'
+              ),
+        ]
+        
+    fig['layout'].update(title=Figure_Title("National Cases & Deaths"),
+                         legend=LEGEND)
 
     return fig
     
@@ -539,137 +1775,94 @@ def Make_State_Dict():
 
 #%%
 
-def Make_R_B_National(df_election):
-
-    
-    df_election['positiveIncreasescale'] = df_election['positiveIncrease']/(df_election['Population']/1000000)
-    df_election['deathIncreasescale'] = df_election['deathIncrease']/(df_election['Population']/1000000)
-    Cases = df_election.groupby(['date','2016 Won By'])['positiveIncreasescale'].sum().unstack().reset_index()
-    Deaths = df_election.groupby(['date','2016 Won By'])['deathIncreasescale'].sum().unstack().reset_index()
-    
-    Roll_Avg(Cases, 'States Won By Clinton', [7,20],shift=False)
-    Roll_Avg(Deaths, 'States Won By Clinton', [7,20],shift=False)
-    Roll_Avg(Cases, 'States Won By Trump', [7,20],shift=False)
-    Roll_Avg(Deaths, 'States Won By Trump', [7,20],shift=False)
-
-    
-    
-    fig = make_subplots(rows=1, cols=2,
-                    subplot_titles = ['Cases per Day'
-                                          , ' Deaths per Day'],
-                        )
-
-
-    fig.add_trace(
-        go.Line(x=Cases['date'],
-                y=Cases['States Won By Clinton'],
-                marker=dict(color=color['Clinton']),
-                line=dict(width=2),
-                legendgroup = 'solidC',
-                name='Won By Clinton'
-                ),row=1,col=1
-        )
-    
-    fig.add_trace(
-        go.Line(x=Cases['date'],
-                y=Cases['States Won By Trump'],
-                marker=dict(color= color['Trump']),
-                line=dict(width=2),
-                legendgroup = 'solidT',
-                name='Won By Trump'
-                ),row=1,col=1
-        )
-    
-    fig.add_trace(
-        go.Line(x=Cases['date'],
-                y=Cases['roll_States Won By Clinton_7'],
-                marker=dict(color= color['Clinton7']),
-                line=dict(width=2, dash ='dash'),
-                legendgroup = 'dashC',
-                name='Clinton 7-Day Avg.'
-                ),row=1,col=1
-        )
-
-    fig.add_trace(
-        go.Line(x=Cases['date'],
-                y=Cases['roll_States Won By Trump_7'],
-                marker=dict(color= color['Trump7']),
-                line=dict(width=2, dash ='dash'),
-                legendgroup = 'dashT',
-                name='Trump 7-Day Avg'
-                ),row=1,col=1
-        )
-
-    fig.update_yaxes(title_text="New Deaths")
- 
-    fig.update_xaxes(title_text="Date")
-
-    
-    fig.add_trace(
-        go.Line(x=Deaths['date'],
-                y=Deaths['States Won By Clinton'],
-                marker=dict(color=color['Clinton']),
-                line=dict(width=2),
-                showlegend=False,
-                legendgroup = 'solidC',
-                name='Won By Clinton'
-                ),row=1,col=2
-        )
-
-
-    fig.add_trace(
-        go.Line(x=Deaths['date'],
-                y=Deaths['States Won By Trump'],
-                marker=dict(color=color['Trump']),
-                line=dict(width=2),
-                showlegend=False,
-                legendgroup = 'solidT',
-                name='Won By Trump'
-                ),row=1,col=2
-        )
-
-    fig.add_trace(
-        go.Line(x=Deaths['date'],
-                y=Deaths['roll_States Won By Clinton_7'],
-                marker=dict(color=color['Clinton7']),
-                line=dict(width=2, dash ='dash'),
-                showlegend=False,
-                legendgroup = 'dashC',
-                name='Clinton 7-Day Avg'
-                ),row=1,col=2
-        )
-
-    fig.add_trace(
-        go.Line(x=Deaths['date'],
-                y=Deaths['roll_States Won By Trump_7'],
-                marker=dict(color=color['Trump7']),
-                line=dict(width=2, dash ='dash'),
-                showlegend=False,
-                legendgroup = 'dashT',
-                name='Trump 7-Day Avg'
-                ),row=1,col=2
-        )
-
-    fig.update_layout(
-                title=dict(text="Red v Blue States Cases & Deaths Per 1M Population",
-                font={'size':24},
-                x = 0.5),
-    
-                xaxis_title='Date',
-                yaxis_title='New Cases',                
-                legend=dict(
-                               yanchor="top",
-                               y=0.99,
-                               xanchor="left",
-                               x=0.01,),
-                    )
+@Timed('figure.Make_R_B_National')
+def Make_R_B_National(aggregates):
+
+    
+    Cases = aggregates['positiveIncreasescale'].reset_index()
+    Deaths = aggregates['deathIncreasescale'].reset_index()
+    
+    Roll_Avg(Cases, ['States Won By Clinton', 'States Won By Trump'], [7,20],shift=False)
+    Roll_Avg(Deaths, ['States Won By Clinton', 'States Won By Trump'], [7,20],shift=False)
+    dates = Date_Axis(aggregates.index)
+
+    
+    
+    fig = Two_Panel_Figure(['Cases per Day'
+                            , ' Deaths per Day'],
+                           ['Date', 'Date'], ['New Cases', 'New Deaths'])
+
+
+    fig['data'] += [
+        Trace('scatter', dates, Cases['States Won By Clinton'],
+              marker=dict(color=color['Clinton']),
+              line=dict(width=2),
+              legendgroup = 'solidC',
+              name='Won By Clinton'
+              ),
+    
+        Trace('scatter', dates, Cases['States Won By Trump'],
+              marker=dict(color= color['Trump']),
+              line=dict(width=2),
+              legendgroup = 'solidT',
+              name='Won By Trump'
+              ),
+    
+        Trace('scatter', dates, Cases['roll_States Won By Clinton_7'],
+              marker=dict(color= color['Clinton7']),
+              line=dict(width=2, dash ='dash'),
+              legendgroup = 'dashC',
+              name='Clinton 7-Day Avg.'
+              ),
+
+        Trace('scatter', dates, Cases['roll_States Won By Trump_7'],
+              marker=dict(color= color['Trump7']),
+              line=dict(width=2, dash ='dash'),
+              legendgroup = 'dashT',
+              name='Trump 7-Day Avg'
+              ),
+    
+        Trace('scatter', dates, Deaths['States Won By Clinton'], col=2,
+              marker=dict(color=color['Clinton']),
+              line=dict(width=2),
+              showlegend=False,
+              legendgroup = 'solidC',
+              name='Won By Clinton'
+              ),
+
+        Trace('scatter', dates, Deaths['States Won By Trump'], col=2,
+              marker=dict(color=color['Trump']),
+              line=dict(width=2),
+              showlegend=False,
+              legendgroup = 'solidT',
+              name='Won By Trump'
+              ),
+
+        Trace('scatter', dates, Deaths['roll_States Won By Clinton_7'], col=2,
+              marker=dict(color=color['Clinton7']),
+              line=dict(width=2, dash ='dash'),
+              showlegend=False,
+              legendgroup = 'dashC',
+              name='Clinton 7-Day Avg'
+              ),
+
+        Trace('scatter', dates, Deaths['roll_States Won By Trump_7'], col=2,
+              marker=dict(color=color['Trump7']),
+              line=dict(width=2, dash ='dash'),
+              showlegend=False,
+              legendgroup = 'dashT',
+              name='Trump 7-Day Avg'
+              ),
+        ]
+
+    fig['layout'].update(title=Figure_Title("Red v Blue States Cases & Deaths Per 1M Population"),
+                         legend=LEGEND)
     return fig 
 
 
 #%% 
-def State_Pop(df) :
-
-    State_Pop = {'AK': 731545.0,
+# 2019 population of each state, looked up by state when aggregating rather than stored per row
+STATE_POPULATION = pd.Series({'AK': 731545.0,
      'AL': 4903185.0,
      'AR': 3017804.0,
      'AZ': 7278717.0,
@@ -719,12 +1912,21 @@ def State_Pop(df) :
      'WA': 7614893.0,
      'WI': 5822434.0,
      'WV': 1792147.0,
-     'WY': 578759.0}
+     'WY': 578759.0})
+
+
+@Timed('clean.State_Pop')
+def State_Pop(df) :
     
-    df['Population'] = df['state'].map(State_Pop)
-    df_election = df[df['Population'].notna()] # Define df with states with no vote info (US Territories) removed
+    df_election = df[df['state'].isin(STATE_POPULATION.index)] # Define df with states with no population (US Territories) removed
 
-    return df_election
+    return df_election.assign(state=df_election['state'].cat.remove_unused_categories())
+
+
+def Population(states):
+    """Population of each of the given states, in their order"""
+    
+    return STATE_POPULATION.reindex(states).to_numpy()
 
 #%%
 
@@ -814,6 +2016,9 @@ def Merge_Pop(df_to_merge):
 
 #%%
 
+WON_BY = pd.CategoricalDtype(['States Won By Clinton', 'States Won By Trump'])
+
+@Timed('clean.States_Won')
 def States_Won(df):
     """# Adds a categorical column of who won each state in the 2016 election 
     and creates a new df_election without US Territories"""
@@ -871,307 +2076,180 @@ def States_Won(df):
     'WV': 'Trump',
     'WY': 'Trump'
     }
-    # Add catagorical column that identifies if state was won by Trump or Clinton
-    df['2016 Won By'] = df['state'].map(states_won)
-    df_election = df[df['2016 Won By'].notna()] # Define df with states with no vote info (US Territories) removed
-    df_election['2016 Won By'] = df_election['2016 Won By'].apply(lambda x: 'States Won By '+str(x))
+    # Add catagorical column that identifies if state was won by Trump or Clinton, the label
+    # is found once per state and spread to the rows through the state codes
+    won = 'States Won By ' + pd.Series(states_won).reindex(df['state'].cat.categories)
+    codes = pd.Categorical(won, dtype=WON_BY).codes[df['state'].cat.codes.to_numpy()]
+    
+    # Define df with states with no vote info (US Territories) removed
+    df_election = df[codes >= 0].assign(**{'2016 Won By': pd.Categorical.from_codes(codes[codes >= 0], dtype=WON_BY)})
 
     return df_election
 
 #%%
 
-def Make_R_B_Sum (df_election) :
-    
-    R_B_national_cases = df_election.groupby(['date','2016 Won By']).sum()['positiveIncrease'].unstack().reset_index()
-    R_B_national_cases=R_B_national_cases.set_index('date').cumsum().reset_index()
-    
-
-    fig = make_subplots(rows=1, cols=2,
-                    subplot_titles = ['R v B States Total Cases'
-                                          , 'R v B States Total Deaths'],
-                        )
-    
-    fig.add_trace(
-        go.Line(x=R_B_national_cases['date'],
-                y=R_B_national_cases['States Won By Clinton'],
-                marker=dict(color= color['Clinton']),
-                line=dict(width=4),
-                legendgroup='Blue',
-                name='Blue States Total'
-                ),row=1 , col=1
-    )
-    
-    fig.add_trace(
-        go.Line(x=R_B_national_cases['date'],
-                y=R_B_national_cases['States Won By Trump'],
-                marker=dict(color= color['Trump']),
-                line=dict(width=4),
-                legendgroup='Red',
-                name='Red States Total'
-                ),row=1 , col=1
-    )
-    
-       
-
-    fig.update_yaxes(title_text="Total Deaths")
- 
-    fig.update_xaxes(title_text="Date")
-    
-    R_B_national_deaths = df_election.groupby(['date','2016 Won By']).sum()['deathIncrease'].unstack().reset_index()
-    R_B_national_deaths= R_B_national_deaths.set_index('date').cumsum().reset_index()
-
-    
-
-
-    fig.add_trace(
-        go.Line(x=R_B_national_deaths['date'],
-                y=R_B_national_deaths['States Won By Clinton'],
-                marker=dict(color= color['Clinton']),
-                #showlegend=False,
-                line=dict(width=4),
-                legendgroup='Blue',
-                showlegend=False,
-                name='Blue States Deaths Total'
-                ),row=1 , col=2
-    )
-    
-    fig.add_trace(
-        go.Line(x=R_B_national_deaths['date'],
-                y=R_B_national_deaths['States Won By Trump'],
-                marker=dict(color= color['Trump']),
-                #showlegend=False,
-                line=dict(width=4),
-                legendgroup='Red',
-                showlegend=False,
-                name='Red States Deaths Total'
-                ),row=1 , col=2
-    )
+@Timed('figure.Make_R_B_Sum')
+def Make_R_B_Sum (aggregates) :
+    
+    R_B_national_cases = aggregates['positiveTotal'][list(WON_BY.categories)].reset_index()
+    R_B_national_deaths = aggregates['deathTotal'][list(WON_BY.categories)].reset_index()
+    dates = Date_Axis(aggregates.index)
+    
+
+    fig = Two_Panel_Figure(['R v B States Total Cases'
+                            , 'R v B States Total Deaths'],
+                           ['Date', 'Date'], ['Total Cases', 'Total Deaths'])
+    
+    fig['data'] += [
+        Trace('scatter', dates, R_B_national_cases['States Won By Clinton'],
+              marker=dict(color= color['Clinton']),
+              line=dict(width=4),
+              legendgroup='Blue',
+              name='Blue States Total'
+              ),
+    
+        Trace('scatter', dates, R_B_national_cases['States Won By Trump'],
+              marker=dict(color= color['Trump']),
+              line=dict(width=4),
+              legendgroup='Red',
+              name='Red States Total'
+              ),
+
+        Trace('scatter', dates, R_B_national_deaths['States Won By Clinton'], col=2,
+              marker=dict(color= color['Clinton']),
+              line=dict(width=4),
+              legendgroup='Blue',
+              showlegend=False,
+              name='Blue States Deaths Total'
+              ),
+    
+        Trace('scatter', dates, R_B_national_deaths['States Won By Trump'], col=2,
+              marker=dict(color= color['Trump']),
+              line=dict(width=4),
+              legendgroup='Red',
+              showlegend=False,
+              name='Red States Deaths Total'
+              ),
+        ]
         
-    fig.update_layout(
-                title= dict(text="Red v Blue States Total Cases & Deaths",
-                        font={'size':24},
-                        x = 0.5),
-                xaxis_title='Date',
-                yaxis_title='Total Cases',                
-                legend=dict(
-                               yanchor="top",
-                               y=0.99,
-                               xanchor="left",
-                               x=0.01,),
-                    )
+    fig['layout'].update(title=Figure_Title("Red v Blue States Total Cases & Deaths"),
+                         legend=LEGEND)
 
     return fig 
 
 #%%
 
-def Make_Top_Ten(df) :
-
-    df_top = df[['state','date','positiveIncrease','deathIncrease','totalTestResultsIncrease','Population']].reset_index()
-
-    today = df_top.date.max()
-
-    df_top['Date'] = pd.to_datetime(df_top['date'], format= '%Y%m%d')
-    df_top.set_index(['state','Date'],inplace=True)
-    df_top.sort_index(inplace=True)
-
-
-    df_top['PosIncScaled'] = df_top['positiveIncrease'] / (df_top['Population']/1000000)
-    df_top['TestIncScaled'] = df_top['totalTestResultsIncrease'] / (df_top['Population']/1000000)
-
-    df_top['PosDiffScaled_m'] = df_top.groupby(level='state')['PosIncScaled'].apply(lambda x: (x.rolling(10).mean()))
-    df_top['TestIncScaled_m'] = df_top.groupby(level='state')['TestIncScaled'].apply(lambda x: (x.rolling(10).mean()))
-
-
-
-    largest = df_top[df_top['date']==today]['PosDiffScaled_m'].nlargest(10).astype(int)
-    largest
-    df_top_c = pd.DataFrame(largest).reset_index().sort_index(ascending=False)
-
-    states = list(df_top_c.state)
-
-    df_top.reset_index(inplace=True)
-    df_top_t = df_top[(df_top['date']==today) & (df_top['state'].isin(states))]
-    df_top_t = df_top_t.sort_values(by=['PosDiffScaled_m'],ascending=True)
-
-    fig = make_subplots(rows=1, cols=2,
-                    subplot_titles = ['States With Most Daily Cases (per Capita)'
-                                          , 'Per Capita Testing'],
-                        )
+@Timed('figure.Make_Top_Ten')
+def Make_Top_Ten(data) :
+
+    hotspots = data['hotspots']
+    per_million = data['population']/1000000
+    
+    # 10 day averages per 1M people on the latest date, a missing day leaves a state out
+    cases = hotspots['cases'].mean(axis=1) / per_million
+    tests = hotspots['tests'].mean(axis=1) / per_million
+
+    # ten largest, smallest first so the biggest bar ends up on top
+    top = Rank_Hotspots(cases, 10)[::-1]
+    states = list(data['roll']['states'][top])
+
+    df_top_c = pd.DataFrame({'state': states, 'PosDiffScaled_m': cases[top].astype(int)})
+    df_top_t = pd.DataFrame({'state': states, 'TestIncScaled_m': tests[top]})
+
+    fig = Two_Panel_Figure(['States With Most Daily Cases (per Capita)'
+                            , 'Per Capita Testing'],
+                           ['10-Day Avg Cases per 1M', '10-Day Avg Tests per 1M'])
+    
+    fig['data'] += [
+        Trace('bar', df_top_c['PosDiffScaled_m'], df_top_c['state'],
+              orientation = 'h',
+              marker=dict(color=color['Clinton']),
+              showlegend=False,
+              name= '10-Day Avg Cases per Day'
+              ),
+    
+        Trace('bar', df_top_t['TestIncScaled_m'], df_top_t['state'], col=2,
+              marker=dict(color=color['20-day']),
+              legendgroup = 'Bar',
+              orientation = 'h',
+              showlegend=False,
+              name='10-Day Avg Tests per Day'
+              ),
+        ]
+        
+    fig['layout']['title'] = Figure_Title("Per Capita Hotspots")
     
-    fig.add_trace(
-        go.Bar(x= df_top_c['PosDiffScaled_m'],
-                y= df_top_c['state'],
-                orientation = 'h',
-                marker=dict(color=color['Clinton']),
-                showlegend=False,
-                name= '10-Day Avg Cases per Day'
-                ),row=1,col=1)
+    return fig
 
+#%%
 
- 
-    fig.update_xaxes(title_text="10-Day Avg Tests per 1M"),    
+@Timed('figure.Make_National_Test_Plot')
+def Make_National_Test_Plot(aggregates) :
+    
+    National = aggregates.xs('National', axis=1, level=1)[
+        ['positiveIncrease', 'totalTestResultsIncrease', 'PosPerTest']].reset_index()
+    dates = Date_Axis(aggregates.index)
 
+    Roll_Avg(National, ['totalTestResultsIncrease', 'positiveIncrease', 'PosPerTest'], [7],shift=False)
     
-    fig.add_trace(
-        go.Bar(x= df_top_t['TestIncScaled_m'],
-                y= df_top_t['state'],
-                marker=dict(color=color['20-day']),
-                legendgroup = 'Bar',
-                orientation = 'h',
-                showlegend=False,
-                
-                name='10-Day Avg Tests per Day'
-                ),row=1, col=2
-    )
+    # secondary y scale for infection rate
+    fig = Secondary_Y_Figure('Date', 'Tests', 'Infection Rate (%)', [0,30])
     
-
+    fig['data'] += [
+        # Add barplot of total tests per day
+        Trace('bar', dates, National['totalTestResultsIncrease'],
+              marker=dict(color=color['Bar']),
+              name='Total Tests',
+              legendgroup = 'Tests',
+              offsetgroup='0'
+              ),
         
-    fig.update_layout(
-                title= dict(text ="Per Capita Hotspots",
-                font=dict(size=24),
-                x = 0.5),
-                xaxis_title='10-Day Avg Cases per 1M'),
-                
-    
-    return fig
-
-#%%
-
-def Make_National_Test_Plot(df) :
-    
-    national_test = df.groupby('date')['totalTestResultsIncrease'].sum().reset_index()
-
-    national_test['date'] = national_test.date.dt.strftime('%Y-%m-%d')
-    Roll_Avg(national_test, 'totalTestResultsIncrease', [7],shift=False)
-
-    national_case = df.groupby('date')['positiveIncrease'].sum().reset_index()
-
-    national_case['date'] = national_case.date.dt.strftime('%Y-%m-%d')
-    Roll_Avg(national_case, 'positiveIncrease', [7],shift=False)
-
-    National = national_case.merge(national_test, on = 'date')
-
-    National['PosPerTest'] = (National['positiveIncrease']/National['totalTestResultsIncrease'])*100
-    Roll_Avg(National, 'PosPerTest', [7],shift=False)
-    
-    #Create Plotly figure objects
-    fig = go.Figure()
-    fig = make_subplots(specs=[[{"secondary_y": True}]])#secondary y scale for infection rate
-    
-    # Add barplot of total tests per day
-    fig.add_trace(
-        go.Bar(x=National['date'],
-               y=National['totalTestResultsIncrease'],
-               marker=dict(color=color['Bar']),
-               name='Total Tests',
-               legendgroup = 'Tests',
-               offsetgroup=0
-               ),
-        secondary_y=False
-               
-    )
-    
-    # Add barplotof positive tests per day
-    fig.add_trace(
-        go.Bar(x=National['date'],
-               y=National['positiveIncrease'],
-               marker=dict(color=color['Bar2']),
-               name='Positive Tests',
-               offsetgroup=0,
-               legendgroup = 'Cases'
-               ),
-        secondary_y=False
-               
-    )
-    
-    #Rolling average trace of testing 
-    fig.add_trace(
-        go.Line(x=National['date'],
-                y=National['roll_totalTestResultsIncrease_7'],
-                marker=dict(color='Black'),
-                line=dict(width=2),
-                name='7-Day Average',
-                legendgroup = 'Tests'
-                ),
-        secondary_y=False
-                
+        # Add barplotof positive tests per day
+        Trace('bar', dates, National['positiveIncrease'],
+              marker=dict(color=color['Bar2']),
+              name='Positive Tests',
+              offsetgroup='0',
+              legendgroup = 'Cases'
+              ),
         
-    )
-    
-    # Rolling average line of positive tests
-    fig.add_trace(
-        go.Line(x=National['date'],
-                y=National['roll_positiveIncrease_7'],
-                marker=dict(color='FireBrick'),
-                line=dict(width=2),
-                name='7-Day Average',
-                legendgroup = 'Cases'
-                ),
-        secondary_y=False
-                
+        #Rolling average trace of testing 
+        Trace('scatter', dates, National['roll_totalTestResultsIncrease_7'],
+              marker=dict(color='Black'),
+              line=dict(width=2),
+              name='7-Day Average',
+              legendgroup = 'Tests'
+              ),
         
-    )
-    
-    # Scatter of d=Infection Rate
-    fig.add_trace(
-        go.Scatter(x=National['date'],
-                y=National['PosPerTest'],
-                mode='markers',
-                marker=dict(color='Green',size=7),
-                name='Infection Rate',
-                legendgroup = 'Infection'
-                ),
-        secondary_y=True           
-                
+        # Rolling average line of positive tests
+        Trace('scatter', dates, National['roll_positiveIncrease_7'],
+              marker=dict(color='FireBrick'),
+              line=dict(width=2),
+              name='7-Day Average',
+              legendgroup = 'Cases'
+              ),
         
-    )
-    
-    # Rolling average of Infection Rate
-    fig.add_trace(
-        go.Line(x=National['date'],
-                y=National['roll_PosPerTest_7'],
-                marker=dict(color='forestgreen'),
-                line=dict(width=3),
-                name='7-Day Average Infection Rate',
-                legendgroup = 'Infection'
-                ),
-        secondary_y=True
-    )
+        # Scatter of d=Infection Rate
+        Trace('scatter', dates, National['PosPerTest'], secondary_y=True,
+              mode='markers',
+              marker=dict(color='Green',size=7),
+              name='Infection Rate',
+              legendgroup = 'Infection'
+              ),
+        
+        # Rolling average of Infection Rate
+        Trace('scatter', dates, National['roll_PosPerTest_7'], secondary_y=True,
+              marker=dict(color='forestgreen'),
+              line=dict(width=3),
+              name='7-Day Average Infection Rate',
+              legendgroup = 'Infection'
+              ),
+        ]
     
     # Setup the layout of legend and title 
-    fig.update_layout(height=700, width=1000,title=dict(text= 'National Tests and Infection Rate',
-                      x=0.5,
-                      font=dict(size=24)),
-                      legend=dict(
-                               yanchor="top",
-                               y=0.99,
-                               xanchor="left",
-                               x=0.01,),
-                      yaxis2_showgrid=False
-                             
-    )
-    # Update Axis labels and range
-    fig.update_yaxes(title_text="Tests", secondary_y=False)
-    fig.update_yaxes(title_text="Infection Rate (%)",secondary_y=True, range=[0,30]) 
-    fig.update_xaxes(title_text="Date")
+    fig['layout'].update(height=700, width=1000,
+                         title=Figure_Title('National Tests and Infection Rate'),
+                         legend=LEGEND)
     return fig
 
 
 
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-